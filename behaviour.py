@@ -0,0 +1,219 @@
+"""Behavioural summary of every subject, computed from its labels file only.
+
+The morph means, the fitted sigmoid and the low/high inflexions of the
+subjects are fitted in parallel and persisted in one table,
+`cache/behaviour.csv`, with one row per subject and runs fitted on. Each
+row keeps the hash of the labels file it comes from, so a subject is only
+refitted when its labels change, whichever runs other callers ask for.
+The sigmoid exclusion and the contrast binning both read that table.
+
+`bootstrap` gives confidence intervals of the same quantities, every
+resample of every subject being fitted in one batch.
+"""
+import os
+import hashlib
+import warnings
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import label_store
+from stats import SIGMOID_P0, compute_morph_scores, fit_sigmoid, find_inflexion, fit_sigmoids, find_inflexions
+
+
+MORPH_LEVELS = list(range(5, 100, 10))
+PARAMETERS = ["L", "x0", "k", "b"]
+COLUMNS = (["subject", "labels_hash", "runs"] + [f"mean_{level}" for level in MORPH_LEVELS] + PARAMETERS
+           + ["low_inflexion", "high_inflexion", "error"])
+
+# folder -> behaviour table of the process, indexed by (subject, runs)
+_tables = {}
+
+# labels path -> (size, mtime, hash)
+_hashes = {}
+
+
+def table_path(folder):
+    return f"{folder}/cache/behaviour.csv"
+
+
+def labels_hash(folder, subject_id):
+    path = label_store.labels_path(folder, subject_id)
+    stat = os.stat(path)
+
+    # hashed once per version of the file
+    entry = _hashes.get(path)
+    if entry is None or entry[:2] != (stat.st_size, stat.st_mtime_ns):
+        with open(path, "rb") as f:
+            entry = (stat.st_size, stat.st_mtime_ns, hashlib.sha1(f.read()).hexdigest()[:16])
+        _hashes[path] = entry
+
+    return entry[2]
+
+
+def summarize(labels, low_percentile=25, high_percentile=75):
+    """Morph means, sigmoid parameters and inflexions of one subject's labels, as Subject.compute_inflexions."""
+    mean, _ = compute_morph_scores(labels)
+
+    popt, fitted_curve = fit_sigmoid(mean)
+    curve = np.array(mean["response"])
+
+    low_inflexion = find_inflexion(curve, np.percentile(fitted_curve, low_percentile))
+    high_inflexion = find_inflexion(curve, np.percentile(fitted_curve, high_percentile))
+
+    return {**{f"mean_{level}": value for level, value in zip(mean.index, curve)},
+            **dict(zip(PARAMETERS, popt)),
+            "low_inflexion": low_inflexion, "high_inflexion": high_inflexion}
+
+
+def runs_key(runs):
+    return "all" if runs is None else ",".join(str(run) for run in runs)
+
+
+def subject_labels(folder, subject_id, runs=None):
+    if runs is None:
+        return label_store.subject_labels(folder, subject_id)
+    return pd.concat([label_store.run_labels(folder, subject_id, run) for run in runs], ignore_index=True)
+
+
+def fit_subject(folder, subject_id, runs=None):
+    row = {"subject": subject_id, "labels_hash": labels_hash(folder, subject_id), "runs": runs_key(runs)}
+
+    try:
+        row.update(summarize(subject_labels(folder, subject_id, runs)))
+    except Exception as e:
+        # kept in the table, the subject is then excluded without being refitted
+        row["error"] = f"{type(e).__name__}: {e}"
+
+    return row
+
+
+def _read(folder):
+    try:
+        return pd.read_csv(table_path(folder), index_col=["subject", "runs"], float_precision="round_trip",
+                           dtype={"labels_hash": str, "runs": str, "error": str})
+    except (OSError, ValueError):
+        return pd.DataFrame(columns=COLUMNS).set_index(["subject", "runs"])
+
+
+def _write(folder, table):
+    path = table_path(folder)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    table.to_csv(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load(subject_ids, folder=".", runs=None, workers=None):
+    """Behaviour table of `subject_ids` fitted on `runs` (all of them when None), indexed by subject.
+
+    Subjects missing from the stored table for these runs, or whose labels
+    file changed since, are fitted in parallel and the table is saved again;
+    the fits on other runs are kept. Subjects without a labels file are left
+    out.
+    """
+    subject_ids = sorted(s for s in subject_ids if os.path.exists(label_store.labels_path(folder, s)))
+
+    table = _tables.get(folder)
+    if table is None:
+        table = _read(folder)
+
+    key = runs_key(runs)
+    stale = [s for s in subject_ids
+             if (s, key) not in table.index or table.at[(s, key), "labels_hash"] != labels_hash(folder, s)]
+
+    if stale:
+        if workers == 1 or len(stale) == 1:
+            rows = [fit_subject(folder, s, runs) for s in stale]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                rows = list(pool.map(partial(fit_subject, folder, runs=runs), stale))
+
+        fitted = pd.DataFrame(rows, columns=COLUMNS).set_index(["subject", "runs"])
+
+        # merged with the stored table again, the rows other processes wrote since are kept
+        table = pd.concat([_read(folder).drop(index=fitted.index, errors="ignore"), fitted]).sort_index()
+        _write(folder, table)
+
+    _tables[folder] = table
+    return table.xs(key, level="runs").loc[subject_ids]
+
+
+def inflexions(subject_id, folder=".", runs=None):
+    """(low, high) inflexions of the subject, None where the fit found none."""
+    row = load([subject_id], folder, runs).loc[subject_id]
+    if isinstance(row["error"], str):
+        raise ValueError(f"No sigmoid fit for subject {subject_id}: {row['error']}")
+
+    return tuple(None if pd.isna(row[col]) else float(row[col]) for col in ("low_inflexion", "high_inflexion"))
+
+
+def excluded(subject_ids, folder=".", runs=None, workers=None):
+    """Subjects whose inflexions are missing or outside of [0.1, 0.5] (low) and [0.5, 0.9] (high)."""
+    table = load(subject_ids, folder, runs, workers)
+    low, high = table["low_inflexion"], table["high_inflexion"]
+
+    # NaN inflexions (failed fit, no crossing) fail every comparison and are excluded
+    kept = (low >= 0.1) & (low <= 0.5) & (high >= 0.5) & (high <= 0.9)
+    return set(subject_ids) - set(table.index[kept])
+
+
+def resampled_means(labels, n_resamples, rng):
+    """(n_resamples, n_levels) mean responses, the trials drawn with replacement within each morph level."""
+    means = []
+    for _, responses in labels.groupby("morph level", sort=True)["response"]:
+        values = responses.to_numpy(dtype=np.float64)
+        means.append(values[rng.integers(0, len(values), (n_resamples, len(values)))].mean(axis=1))
+
+    return np.stack(means, axis=1)
+
+
+def summarize_batch(means, p0=SIGMOID_P0, low_percentile=25, high_percentile=75):
+    """`summarize` of every row of the (n, 10) morph means: parameters, low and high inflexions, NaN where it fails."""
+    params, fitted_curves = fit_sigmoids(means, p0)
+
+    low_inflexion = find_inflexions(means, np.percentile(fitted_curves, low_percentile, axis=1))
+    high_inflexion = find_inflexions(means, np.percentile(fitted_curves, high_percentile, axis=1))
+
+    return params, low_inflexion, high_inflexion
+
+
+def bootstrap(subject_ids, folder=".", runs=None, n_resamples=2000, confidence=0.95, seed=0):
+    """Percentile bootstrap intervals of the sigmoid parameters and inflexions of every subject.
+
+    Each resample starts from its subject's fit in the behaviour table.
+    Returns one row per subject and quantity with the table's estimate,
+    the interval and the fraction of resamples whose fit failed.
+    """
+    table = load(subject_ids, folder, runs)
+    rng = np.random.default_rng(seed)
+
+    means = np.concatenate([resampled_means(subject_labels(folder, subject, runs), n_resamples, rng)
+                            for subject in table.index])
+
+    start = table[PARAMETERS].to_numpy(dtype=np.float64)
+    start[np.isnan(start).any(axis=1)] = SIGMOID_P0
+
+    params, low_inflexion, high_inflexion = summarize_batch(means, np.repeat(start, n_resamples, axis=0))
+
+    quantities = PARAMETERS + ["low_inflexion", "high_inflexion"]
+    values = np.column_stack([params, low_inflexion, high_inflexion]).reshape(len(table), n_resamples, -1)
+
+    tail = (1 - confidence) / 2 * 100
+    failed = np.isnan(values).mean(axis=1)
+    with warnings.catch_warnings():
+        # subjects whose resamples all failed get NaN intervals
+        warnings.simplefilter("ignore", RuntimeWarning)
+        ci_low, ci_high = np.nanpercentile(values, [tail, 100 - tail], axis=1)
+
+    return pd.DataFrame({
+        "subject": np.repeat(table.index.to_numpy(), len(quantities)),
+        "quantity": quantities * len(table),
+        "estimate": table[quantities].to_numpy(dtype=np.float64).ravel(),
+        "ci_low": ci_low.ravel(),
+        "ci_high": ci_high.ravel(),
+        "failed": failed.ravel(),
+    })
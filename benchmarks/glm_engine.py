@@ -0,0 +1,48 @@
+"""Compare the native GLM engine with the nilearn FirstLevelModel path on one subject.
+
+Run from the repository root:
+    python benchmarks/glm_engine.py --subject 2 --smoothing 3 5 7
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gen_contrasts import Config, GLM_contrast_map
+
+
+def run_engine(cfg, subject, engine):
+    cfg.GLM_ENGINE = engine
+
+    start = time.perf_counter()
+    z_maps = GLM_contrast_map(cfg, None, subject, "morph level", cfg.PREDICTORS == "morph_with_response")
+
+    return time.perf_counter() - start, z_maps
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subject", type=int, default=2)
+    parser.add_argument("--smoothing", type=float, nargs="+", default=[5])
+    parser.add_argument("--per-run", action="store_true")
+    args = parser.parse_args()
+
+    cfg = Config()
+    cfg.FIT_PER_RUN = args.per_run
+
+    for fwhm in args.smoothing:
+        cfg.SMOOTHING_FWHM = fwhm
+
+        nilearn_time, nilearn_maps = run_engine(cfg, args.subject, "nilearn")
+        native_time, native_maps = run_engine(cfg, args.subject, "native")
+
+        max_diff = max(np.abs(nilearn_maps[name].get_fdata() - native_maps[name].get_fdata()).max()
+                       for name in nilearn_maps)
+
+        print(f"{fwhm=}: nilearn {nilearn_time:.2f}s, native {native_time:.2f}s "
+              f"({nilearn_time / native_time:.1f}x), max |z difference| {max_diff:.2e}")
@@ -0,0 +1,51 @@
+"""Import time of the modules every pool worker loads, each in a fresh interpreter.
+
+Fails when one of them pulls matplotlib in or takes longer than the budget,
+from the repository root:
+    python benchmarks/import_time.py --repeats 5 --budget 3
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# imported by clean_data and the GLM workers, none of them plots
+WORKER_MODULES = ["stats", "mri_loader"]
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - start, "matplotlib": "matplotlib" in sys.modules}}))
+"""
+
+
+def import_time(module):
+    output = subprocess.run([sys.executable, "-c", PROBE.format(module=module)], cwd=ROOT,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", nargs="+", default=WORKER_MODULES)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=3.0, help="seconds allowed per import")
+    args = parser.parse_args()
+
+    failed = False
+    for module in args.modules:
+        runs = [import_time(module) for _ in range(args.repeats)]
+        seconds = np.median([run["seconds"] for run in runs])
+        plotting = any(run["matplotlib"] for run in runs)
+
+        print(f"{module}: {seconds:.3f}s median of {args.repeats}, matplotlib {'imported' if plotting else 'not imported'}")
+        failed |= plotting or seconds > args.budget
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,58 @@
+"""Compare the batched sigmoid fit with one curve_fit call per curve.
+
+Runs on synthetic psychometric curves, from the repository root:
+    python benchmarks/sigmoid_fit.py --curves 20000
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+from scipy.optimize import curve_fit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stats import SIGMOID_P0, sigmoid, fit_sigmoids
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--curves", type=int, default=20000)
+    parser.add_argument("--noise", type=float, default=0.05)
+    parser.add_argument("--curve-fit-curves", type=int, default=500)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    xdata = np.linspace(0.05, 0.95, 10)
+
+    # decreasing curves around the middle of the morph, as the responses of the task
+    true = np.column_stack([rng.uniform(-1, -0.6, args.curves), rng.uniform(0.3, 0.7, args.curves),
+                            rng.uniform(8, 25, args.curves), rng.uniform(0.9, 1.0, args.curves)])
+    ydata = np.clip(sigmoid(xdata, *true.T[..., np.newaxis]) + rng.normal(0, args.noise, (args.curves, 10)), 0, 1)
+
+    start = time.perf_counter()
+    params, _ = fit_sigmoids(ydata)
+    batched_time = time.perf_counter() - start
+
+    reference = np.full((args.curve_fit_curves, 4), np.nan)
+    start = time.perf_counter()
+    with np.errstate(over="ignore"):
+        for i, y in enumerate(ydata[:args.curve_fit_curves]):
+            try:
+                reference[i] = curve_fit(sigmoid, xdata, y, SIGMOID_P0)[0]
+            except RuntimeError:
+                pass
+    curve_fit_time = (time.perf_counter() - start) / args.curve_fit_curves * args.curves
+
+    def cost(p, y):
+        return ((sigmoid(xdata, *p.T[..., np.newaxis]) - y) ** 2).sum(axis=1)
+
+    both = ~np.isnan(params[:args.curve_fit_curves, 0]) & ~np.isnan(reference[:, 0])
+    excess = cost(params[:args.curve_fit_curves][both], ydata[:args.curve_fit_curves][both]) \
+        / cost(reference[both], ydata[:args.curve_fit_curves][both]) - 1
+
+    print(f"{args.curves} curves: batched {batched_time:.2f}s, curve_fit ~{curve_fit_time:.0f}s (extrapolated), "
+          f"failed {np.isnan(params[:, 0]).mean():.2%} vs {np.isnan(reference[:, 0]).mean():.2%}, "
+          f"max relative excess cost {excess.max():.1e}")
@@ -0,0 +1,60 @@
+"""Compare the sign-flip permutation engine with the SecondLevelModel refit of the notebooks.
+
+Runs on synthetic subject maps, from the repository root:
+    python benchmarks/sign_flip.py --subjects 10 --permutations 10000
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import nibabel
+from nilearn.maskers import NiftiMasker
+from nilearn.glm.second_level import SecondLevelModel
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import permutation
+
+
+def nilearn_t(imgs, masker):
+    design_matrix = pd.DataFrame([1] * len(imgs), columns=["intercept"])
+    model = SecondLevelModel(mask_img=masker.mask_img_).fit(imgs, design_matrix=design_matrix)
+    return masker.transform(model.compute_contrast("intercept", output_type="stat")).squeeze()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subjects", type=int, default=10)
+    parser.add_argument("--permutations", type=int, default=10000)
+    parser.add_argument("--shape", type=int, nargs=3, default=[46, 55, 46])
+    parser.add_argument("--nilearn-permutations", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    shape = tuple(args.shape)
+    affine = np.diag([4.0, 4.0, 4.0, 1.0])
+
+    imgs = [nibabel.Nifti1Image(rng.normal(0.2, 1, shape).astype(np.float32), affine) for _ in range(args.subjects)]
+    masker = NiftiMasker(mask_img=nibabel.Nifti1Image(np.ones(shape, dtype=np.uint8), affine)).fit()
+    Y = masker.transform(imgs)
+
+    max_diff = np.abs(nilearn_t(imgs, masker) - permutation.one_sample_t(Y)).max()
+
+    start = time.perf_counter()
+    observed, null, p_values = permutation.permutation_test(Y, args.permutations)
+    native_time = time.perf_counter() - start
+
+    # one SecondLevelModel refit per permutation, as in permutation_tests/*.ipynb
+    start = time.perf_counter()
+    for i in range(args.nilearn_permutations):
+        signs = np.random.RandomState(i).choice([-1, 1], size=args.subjects)
+        nilearn_t(list(masker.inverse_transform(Y * signs[:, np.newaxis]).slicer[..., j]
+                       for j in range(args.subjects)), masker).max()
+    nilearn_time = (time.perf_counter() - start) / args.nilearn_permutations * len(null)
+
+    print(f"{Y.shape=}, {len(null)} permutations: native {native_time:.2f}s, "
+          f"nilearn ~{nilearn_time:.0f}s (extrapolated), max |t difference| {max_diff:.2e}")
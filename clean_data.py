@@ -1,29 +1,139 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
+import pandas as pd
+import nibabel
+
+import run_cache
 from mri_loader import MRI
 
 
-subs = set(range(1,34))
+# clean_img holds the float64 input, its cleaned copy and the filtering buffers
+MEMORY_FACTOR = 3 * np.dtype(np.float64).itemsize
+
+
+def parse_range(value):
+    # "1-10,12,14-16" -> [1, ..., 10, 12, 14, 15, 16]
+    ids = []
+    for part in value.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            ids += list(range(int(start), int(end) + 1))
+        else:
+            ids.append(int(part))
+    return ids
+
+
+def make_mri(sub, run, confound_mode, standardize, folder):
+    mri = MRI(sub, run, folder=folder, confound_mode=confound_mode, use_cache=False)
+
+    if standardize is not None:
+        mri._standardize = standardize
+
+    return mri
 
-# subs = [1, 3, 4, 5, 20, 22, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33]
 
-still_fucked = [1, 3, 13, 22, 32, 33]
+def estimate_memory(mri):
+    shape = nibabel.load(mri._get_file('preproc_bold.nii.gz')).shape
+    return int(np.prod(shape)) * MEMORY_FACTOR
 
 
-for sub in []:  # [11,12,13]:
-    for run in [5]:  # [1,2,3,4,5]:
+def clean_run(sub, run, confound_mode, standardize, folder):
+    start = time.perf_counter()
 
-        print(f'clean {sub} run {run}')
+    # cache() cleans from the BOLD and confounds files only, labels and masks are not needed
+    mri = make_mri(sub, run, confound_mode, standardize, folder)
+    mri.cache(override_cache=True)
+
+    return time.perf_counter() - start
+
+
+def plan(tasks, standardize, folder, override_cache):
+    todo = []
+    rows = []
+
+    for sub, run, confound_mode in tasks:
+        row = {"subject": sub, "run": run, "confound_mode": confound_mode}
 
         try:
-            data = MRI(sub, run, confound_mode="reduced", use_cache=False)
+            mri = make_mri(sub, run, confound_mode, standardize, folder)
+            params = mri.cleaning_params
 
-            data._standardize = "psc"
-            data._detrend = True
+            if not override_cache and run_cache.is_valid(mri._entry_path(params), params):
+                rows.append({**row, "status": "cached", "seconds": 0.0, "error": ""})
+                continue
 
-            data.load()
-            data.cache(override_cache=True)
+            todo.append((row, estimate_memory(mri)))
         except Exception as e:
-            print(e)
-            # raise
+            rows.append({**row, "status": "failed", "seconds": 0.0, "error": str(e)})
+
+    return todo, rows
+
+
+def n_workers(todo, workers, memory_budget):
+    if memory_budget is None or not todo:
+        return workers
+
+    largest = max(memory for _, memory in todo)
+    return max(1, min(workers, int(memory_budget // largest)))
+
+
+def clean_all(subjects, runs, confound_modes,
+              standardize=None,
+              folder=".",
+              workers=None,
+              memory_budget=None,
+              override_cache=False):
+    tasks = [(sub, run, mode) for mode in confound_modes for sub in subjects for run in runs]
+    todo, rows = plan(tasks, standardize, folder, override_cache)
+
+    workers = n_workers(todo, workers or os.cpu_count(), memory_budget)
+    print(f"{len(todo)} runs to clean, {len(rows)} cached or unavailable, {workers} workers")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(clean_run, row["subject"], row["run"], row["confound_mode"], standardize, folder): row
+            for row, _ in todo
+        }
+
+        for future in as_completed(futures):
+            row = futures[future]
+
+            try:
+                rows.append({**row, "status": "cleaned", "seconds": future.result(), "error": ""})
+            except Exception as e:
+                rows.append({**row, "status": "failed", "seconds": np.nan, "error": str(e)})
+
+            print(f"{row['confound_mode']} sub {row['subject']} run {row['run']}: {rows[-1]['status']}")
+
+    summary = pd.DataFrame(rows, columns=["subject", "run", "confound_mode", "status", "seconds", "error"])
+    return summary.sort_values(["confound_mode", "subject", "run"], ignore_index=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Clean and cache the preprocessed runs of the cohort.")
+    parser.add_argument("--subjects", type=parse_range, default=list(range(1, 34)), help="e.g. 1-26 or 11,12,13")
+    parser.add_argument("--runs", type=parse_range, default=[1, 2, 3, 4, 5])
+    parser.add_argument("--confound-modes", nargs="+", default=["full", "reduced"], choices=["full", "reduced"])
+    parser.add_argument("--standardize", default=None, help="overrides MRI._standardize, e.g. psc")
+    parser.add_argument("--folder", default=".")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--memory-budget", type=float, default=None, help="in GB, bounds the worker count")
+    parser.add_argument("--override-cache", action="store_true")
+    args = parser.parse_args()
+
+    memory_budget = args.memory_budget * 1024 ** 3 if args.memory_budget else None
 
+    summary = clean_all(args.subjects, args.runs, args.confound_modes,
+                        standardize=args.standardize,
+                        folder=args.folder,
+                        workers=args.workers,
+                        memory_budget=memory_budget,
+                        override_cache=args.override_cache)
 
+    print(summary.to_string(max_colwidth=80))
+    print(summary.groupby(["confound_mode", "status"]).size().to_string())
@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import run_cache
+
+
+# parsed confound tables, shared by every MRI of the process
+_tables = {}
+
+
+def _wanted(columns):
+    columns = set(columns)
+    return lambda col: col in columns or col.startswith('motion_outlier')
+
+
+def _npz_path(cache_dir, path, stat):
+    name = os.path.basename(path).replace('.tsv', '')
+    return f"{cache_dir}/{name}-{run_cache.cache_key(stat)}.npz"
+
+
+def load(path, columns, cache_dir):
+    """Confound table of `path`, restricted to `columns` and the motion outliers.
+
+    The TSV is parsed once per process and a columnar copy is kept in
+    `cache_dir`, the copy being keyed on the size and mtime of the TSV.
+    """
+    stat = run_cache.source_stat(path)
+    key = (path, stat["size"], stat["mtime"], tuple(sorted(columns)))
+
+    if key not in _tables:
+        _tables[key] = _load(path, columns, cache_dir, stat)
+
+    return _tables[key]
+
+
+def _load(path, columns, cache_dir, stat):
+    npz_path = _npz_path(cache_dir, path, {**stat, "columns": sorted(columns)})
+
+    if os.path.exists(npz_path):
+        with np.load(npz_path) as stored:
+            return pd.DataFrame(stored["values"], columns=stored["columns"])
+
+    table = pd.read_csv(path, delimiter='\t', usecols=_wanted(columns), dtype=np.float64, na_values='n/a')
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{npz_path[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, values=table.to_numpy(), columns=np.array(table.columns, dtype=str))
+    os.replace(tmp_path, npz_path)
+
+    return table
@@ -0,0 +1,139 @@
+"""Contrast matrices of the morph designs, compiled once per column layout.
+
+A contrast is a {"+": [...], "-": [...]} dict of class names, as
+gen_contrast_list builds them. A class is a design column or, for morph
+level designs, a group of the trial type columns "<level>" or
+"<level>_<response>": the level itself ("25"), "low", "high" and
+"undecided" against the inflexions, "button" and "unpressed" by response.
+The (n_contrasts, n_columns) matrix of a contrast list is built once per
+(columns, contrasts, inflexions) and kept for the process. A class that
+matches no column is an error rather than a zero contrast; `expressible`
+leaves out, with a warning, the contrasts a layout cannot express (no
+"button" column in a morph only design).
+"""
+import re
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+
+from stats import contrast_name
+
+
+CONTRAST_CACHE_SIZE = 256
+
+TRIAL_TYPE = re.compile(r"^(\d+)(?:_(\d+))?$")
+
+# key -> read-only contrast matrix, least recently used first
+_matrices = OrderedDict()
+_counters = {"hits": 0, "misses": 0}
+
+
+def column_classes(columns, labels_col="morph level", low_inflexion=None, high_inflexion=None):
+    """Class name -> indices of its design columns, every column being a class of its own."""
+    classes = {str(column): [i] for i, column in enumerate(columns)}
+
+    if labels_col != "morph level":
+        return classes
+
+    if low_inflexion is None or high_inflexion is None:
+        raise ValueError(f"The morph level classes need both inflexions, got {low_inflexion=}, {high_inflexion=}")
+
+    groups = {name: [] for name in ("low", "high", "undecided", "button", "unpressed")}
+    levels = {}
+
+    for i, column in enumerate(columns):
+        match = TRIAL_TYPE.match(str(column))
+        if match is None:
+            continue
+
+        level, response = match.groups()
+        levels.setdefault(str(int(level)), []).append(i)
+
+        # designs without the responses in the trial types have no button classes
+        if response is not None:
+            groups["button" if int(response) == 1 else "unpressed"].append(i)
+
+        morph = int(level) / 100
+        if morph < low_inflexion:
+            groups["low"].append(i)
+        elif morph > high_inflexion:
+            groups["high"].append(i)
+        else:
+            groups["undecided"].append(i)
+
+    classes.update(levels)
+    classes.update(groups)
+    return classes
+
+
+def expressible(layouts, contrast_list, labels_col="morph level", low_inflexion=None, high_inflexion=None):
+    """Contrasts of `contrast_list` whose classes all match columns of every design layout of `layouts`.
+
+    The others are left out with a warning, so the remaining contrasts
+    keep the same rows in the matrices of every run.
+    """
+    classes = [column_classes(columns, labels_col, low_inflexion, high_inflexion) for columns in layouts]
+
+    kept = []
+    for contrast in contrast_list:
+        missing = sorted({name for layout in classes for sign in ("+", "-") for name in contrast.get(sign, [])
+                          if not layout.get(name)})
+        if missing:
+            warnings.warn(f"Contrast {contrast_name(contrast)!r} left out, no design column for {missing} "
+                          f"({labels_col=})")
+            continue
+
+        kept.append(contrast)
+
+    return kept
+
+
+def _build(columns, contrast_list, labels_col, low_inflexion, high_inflexion):
+    classes = column_classes(columns, labels_col, low_inflexion, high_inflexion)
+    matrix = np.zeros((len(contrast_list), len(columns)))
+
+    for row, contrast in zip(matrix, contrast_list):
+        for sign, weight in (("+", 1.0), ("-", -1.0)):
+            for name in contrast.get(sign, []):
+                if not classes.get(name):
+                    raise ValueError(f"Contrast {contrast_name(contrast)!r} needs {name!r}, which matches none of "
+                                     f"the design columns {[str(column) for column in columns]} "
+                                     f"({labels_col=}, {low_inflexion=}, {high_inflexion=})")
+
+                row[classes[name]] += weight
+
+    matrix.setflags(write=False)
+    return matrix
+
+
+def contrast_matrix(columns, contrast_list, labels_col="morph level", low_inflexion=None, high_inflexion=None):
+    """(n_contrasts, n_columns) weights of `contrast_list` on the design `columns`, memoised.
+
+    Subjects and runs sharing a layout and inflexions, and the sweep
+    configurations of a subject, get the matrix of a previous call.
+    """
+    columns = tuple(str(column) for column in columns)
+    key = (columns, tuple(contrast_name(contrast) for contrast in contrast_list), labels_col,
+           low_inflexion, high_inflexion)
+
+    if key in _matrices:
+        _counters["hits"] += 1
+        _matrices.move_to_end(key)
+    else:
+        _counters["misses"] += 1
+
+        _matrices[key] = _build(columns, contrast_list, labels_col, low_inflexion, high_inflexion)
+        if len(_matrices) > CONTRAST_CACHE_SIZE:
+            _matrices.popitem(last=False)
+
+    return _matrices[key]
+
+
+def cache_info():
+    return {**_counters, "size": len(_matrices), "maxsize": CONTRAST_CACHE_SIZE}
+
+
+def clear_cache():
+    _matrices.clear()
+    _counters.update(hits=0, misses=0)
@@ -0,0 +1,152 @@
+"""Per-configuration stack of the subject z-maps saved by gen_contrasts.
+
+The maps are ingested once into a single (contrast, subject, voxel) float32
+`.npy` restricted to the voxels the subjects cover, with a JSON index of the
+contrasts, subjects, grid and source files next to it. Group analyses
+memory-map that file instead of loading hundreds of gzipped NIfTIs; the
+stack is rebuilt when a source map changes.
+"""
+import os
+import json
+from dataclasses import dataclass
+
+import numpy as np
+import nibabel
+from nilearn import image
+
+import run_cache
+import gen_contrasts as gc
+
+
+@dataclass
+class ContrastStack:
+    """Subject z-maps restricted to the voxels covered by any subject.
+
+    `data` is a (n_contrasts, n_subjects, n_voxels) float32 array whose last
+    axis follows the C order of the voxels set in `mask`.
+    """
+
+    data: np.ndarray
+    contrasts: list
+    subjects: list
+    mask: np.ndarray
+    affine: np.ndarray
+
+    @property
+    def mask_img(self):
+        return nibabel.Nifti1Image(self.mask.astype(np.uint8), self.affine)
+
+    def contrast(self, c_name):
+        """(n_subjects, n_voxels) maps of `c_name`."""
+        return self.data[self.contrasts.index(c_name)]
+
+    def unmask(self, values):
+        # (n_voxels,) -> 3D image, (n, n_voxels) -> 4D image
+        values = np.asarray(values)
+        grid = np.zeros((*self.mask.shape, *values.shape[:-1]), dtype=values.dtype)
+        grid[self.mask] = values.T
+        return nibabel.Nifti1Image(grid, self.affine)
+
+    def images(self, c_name):
+        """One 3D z-map image per subject, in the order of `subjects`."""
+        return [self.unmask(values) for values in self.contrast(c_name)]
+
+
+def stack_path(cfg, smoothing_fwhm=None, extension=".npy"):
+    smoothed = f"-s{str(smoothing_fwhm).replace('.', '-')}" if smoothing_fwhm else ""
+    return f"brute_force/{gc.path(cfg)}/stack{smoothed}{extension}"
+
+
+def sources(cfg, subjects, contrasts):
+    return {f"{subject}/{c_name}": run_cache.source_stat(gc.contrast_path(cfg, subject, c_name))
+            for c_name in contrasts for subject in subjects}
+
+
+def _load_map(cfg, subject, c_name, smoothing_fwhm):
+    img = nibabel.load(gc.contrast_path(cfg, subject, c_name))
+    if smoothing_fwhm:
+        img = image.smooth_img(img, smoothing_fwhm)
+    return img
+
+
+def build(cfg, subjects, contrasts, smoothing_fwhm=None):
+    """Ingest the z-maps of `subjects` and `contrasts` into the stack file of `cfg`.
+
+    Maps are zero outside of the brain mask of their subject, the stack
+    keeps the voxels any subject covers in the first contrast so no value is
+    lost. The maps are then written one at a time into the memory-mapped
+    stack.
+    """
+    subjects, contrasts = sorted(subjects), list(contrasts)
+    path = stack_path(cfg, smoothing_fwhm)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    first = [nibabel.load(gc.contrast_path(cfg, subject, contrasts[0])) for subject in subjects]
+    mask = np.any([np.asarray(img.dataobj) != 0 for img in first], axis=0)
+    affine = first[0].affine
+
+    tmp_path = f"{path[:-len('.npy')]}.{os.getpid()}.tmp.npy"
+    data = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32,
+                                     shape=(len(contrasts), len(subjects), int(mask.sum())))
+
+    for i, c_name in enumerate(contrasts):
+        for j, subject in enumerate(subjects):
+            img = _load_map(cfg, subject, c_name, smoothing_fwhm)
+            data[i, j] = np.asarray(img.dataobj, dtype=np.float32)[mask]
+
+    data.flush()
+    del data
+    os.replace(tmp_path, path)
+
+    mask_path = stack_path(cfg, smoothing_fwhm, "-mask.npy")
+    np.save(f"{mask_path[:-len('.npy')]}.{os.getpid()}.tmp.npy", mask)
+    os.replace(f"{mask_path[:-len('.npy')]}.{os.getpid()}.tmp.npy", mask_path)
+
+    index = {"contrasts": contrasts, "subjects": subjects, "affine": affine.tolist(),
+             "smoothing_fwhm": smoothing_fwhm, "sources": sources(cfg, subjects, contrasts)}
+
+    index_path = stack_path(cfg, smoothing_fwhm, ".json")
+    with open(f"{index_path}.{os.getpid()}.tmp", "w") as f:
+        json.dump(index, f, indent=2)
+    os.replace(f"{index_path}.{os.getpid()}.tmp", index_path)
+
+
+def read_index(cfg, smoothing_fwhm=None):
+    try:
+        with open(stack_path(cfg, smoothing_fwhm, ".json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_current(cfg, subjects, contrasts, smoothing_fwhm=None):
+    index = read_index(cfg, smoothing_fwhm)
+    if index is None or not os.path.exists(stack_path(cfg, smoothing_fwhm)):
+        return False
+
+    if index["subjects"] != sorted(subjects) or index["contrasts"] != list(contrasts):
+        return False
+
+    try:
+        return index["sources"] == sources(cfg, subjects, contrasts)
+    except OSError:
+        return False
+
+
+def load(cfg, subjects=None, contrasts=None, smoothing_fwhm=None):
+    """Memory-mapped ContrastStack of `cfg`, (re)built first when missing or out of date.
+
+    Without `subjects` and `contrasts`, the existing stack is served as is.
+    """
+    if subjects is not None and contrasts is not None and not is_current(cfg, subjects, contrasts, smoothing_fwhm):
+        build(cfg, subjects, contrasts, smoothing_fwhm)
+
+    index = read_index(cfg, smoothing_fwhm)
+    if index is None:
+        raise FileNotFoundError(f"No contrast stack for {gc.path(cfg)}, build it with its subjects and contrasts")
+
+    return ContrastStack(data=np.load(stack_path(cfg, smoothing_fwhm), mmap_mode="r"),
+                         contrasts=index["contrasts"],
+                         subjects=index["subjects"],
+                         mask=np.load(stack_path(cfg, smoothing_fwhm, "-mask.npy")),
+                         affine=np.array(index["affine"]))
@@ -0,0 +1,67 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from nilearn.glm.first_level import make_first_level_design_matrix
+
+
+DESIGN_CACHE_SIZE = 256
+
+# key -> design matrix, least recently used first
+_designs = OrderedDict()
+_counters = {"hits": 0, "misses": 0}
+
+
+def events_key(events):
+    digest = hashlib.sha1()
+    digest.update(np.asarray(events["onset"], dtype=np.float64).tobytes())
+    digest.update(np.asarray(events["duration"], dtype=np.float64).tobytes())
+    digest.update("\x00".join(str(t) for t in events["trial_type"]).encode())
+    return digest.hexdigest()
+
+
+def design_matrix(events, t_r, n_scans,
+                  hrf_model='spm',
+                  drift_model='polynomial',
+                  drift_order=3,
+                  high_pass=0.01,
+                  sample_mask=None):
+    """HRF-convolved design of a run, memoised on everything it depends on.
+
+    Sweep configurations that only change the smoothing or the confounds, and
+    subjects sharing the same timing, get the design of a previous call. The
+    frame times follow FirstLevelModel (slice_time_ref=0). The full design is
+    cached and the rows are restricted to `sample_mask` on the way out, so
+    masked and unmasked fits share the same entry.
+    """
+    key = (events_key(events), float(t_r), int(n_scans), hrf_model, drift_model, drift_order, high_pass)
+
+    if key in _designs:
+        _counters["hits"] += 1
+        _designs.move_to_end(key)
+    else:
+        _counters["misses"] += 1
+
+        frame_times = np.arange(n_scans) * t_r
+        _designs[key] = make_first_level_design_matrix(frame_times, events,
+                                                       hrf_model=hrf_model,
+                                                       drift_model=drift_model,
+                                                       drift_order=drift_order,
+                                                       high_pass=high_pass)
+        if len(_designs) > DESIGN_CACHE_SIZE:
+            _designs.popitem(last=False)
+
+    design = _designs[key]
+    if sample_mask is not None:
+        return design.iloc[sample_mask].copy()
+
+    return design.copy()
+
+
+def cache_info():
+    return {**_counters, "size": len(_designs), "maxsize": DESIGN_CACHE_SIZE}
+
+
+def clear_cache():
+    _designs.clear()
+    _counters.update(hits=0, misses=0)
@@ -3,6 +3,7 @@ from dataclasses import dataclass
 
 from mri_loader import Subject
 from nilearn.glm.first_level import FirstLevelModel
+from nilearn.masking import unmask
 
 from nilearn.reporting import get_clusters_table
 from nilearn.glm import threshold_stats_img
@@ -11,9 +12,14 @@ import matplotlib.pyplot as plt
 
 import pandas as pd
 import numpy as np
-from lib.mni_to_atlas import AtlasBrowser
-
-from stats import *
+from nilearn import image
+from lib.mni_to_atlas import get_atlas
+from glm import GLM, smoothed_matrix
+import design
+import behaviour
+import contrast_compiler
+
+from stats import contrast_name
 import nibabel
 
 
@@ -28,6 +34,12 @@ class Config:
     USE_SAMPLE_MASKS = True
     SMOOTHING_FWHM = 5
     DURATION = 2.5
+    # fit the runs separately (peak memory of one run) instead of one concatenated series,
+    # which is read whole by the fit; False keeps the concatenated design of the published maps
+    FIT_PER_RUN = False
+    N_JOBS = -1
+    # "nilearn" (FirstLevelModel) or "native" (glm.GLM, every contrast from one fit)
+    GLM_ENGINE = "nilearn"
 
     PREDICTORS = "morph_with_response"
     # PREDICTORS = "morph"
@@ -43,25 +55,10 @@ run_ids = [1, 2, 3, 4]
 
 
 def exclude_with_sigmoid(subject_ids):
-    exclude_inflexion = set()
-
-    for subject in subject_ids:
-        try:
-            dataset = Subject(subject, run_ids)
+    return behaviour.excluded(subject_ids, runs=run_ids)
 
-            low_inflexion, high_inflexion = dataset.compute_inflexions()
 
-            if low_inflexion < 0.1 or high_inflexion > 0.9 or high_inflexion < 0.5 or low_inflexion > 0.5:
-                exclude_inflexion.add(subject)
-        except Exception as e:
-            print(e)
-            exclude_inflexion.add(subject)
-            continue
-
-    return exclude_inflexion
-
-
-def gen_contrast_list():
+def gen_contrast_list(predictors="morph_with_response"):
     contrast_list = [{"+": ["high"], "-": ["low"]},  # high > low
                      {"+": ["undecided"], "-": ["high", "low"]}, ]  # undecided > high + low
 
@@ -74,75 +71,150 @@ def gen_contrast_list():
             **to_subtract
         })
 
-    contrast_list += [{"+": ["button"], "-": ["unpressed"]}]
+    # the button classes need the responses in the trial types
+    if predictors == "morph_with_response":
+        contrast_list += [{"+": ["button"], "-": ["unpressed"]}]
 
     return contrast_list
 
 
-def GLM_contrast_map(cfg, global_z_map, subject_id, labels_col, morph_response):
+def smoothed_images(cfg, subject_id):
+    # smoothed once and shared by the configurations that only differ in design
+    dataset = Subject(subject_id, run_ids, confound_mode=cfg.CONFOUND_MODE, volumes_offset=cfg.VOLUMES_OFFSET)
+    images, _, _ = dataset.get_data(per_run=cfg.FIT_PER_RUN)
+
+    if cfg.FIT_PER_RUN:
+        return [image.smooth_img(img, cfg.SMOOTHING_FWHM) for img in images]
+    return image.smooth_img(images, cfg.SMOOTHING_FWHM)
+
+
+def GLM_contrast_map(cfg, global_z_map, subject_id, labels_col, morph_response, smoothed=None):
     dataset = Subject(subject_id, run_ids, confound_mode=cfg.CONFOUND_MODE, volumes_offset=cfg.VOLUMES_OFFSET)
     dataset.load()
 
-    images, times, labels = dataset.get_data(labels_col=labels_col, morph_response=morph_response)
-    low_inflexion, high_inflexion = dataset.compute_inflexions()
+    images, times, labels = dataset.get_data(labels_col=labels_col,
+                                             morph_response=morph_response,
+                                             per_run=cfg.FIT_PER_RUN)
 
-    sample_mask = dataset.sample_mask
+    # `smoothed` holds the output of smoothed_images() for the same configuration
+    smoothing_fwhm = cfg.SMOOTHING_FWHM
+    if smoothed is not None:
+        images, smoothing_fwhm = smoothed, None
+    low_inflexion, high_inflexion = behaviour.inflexions(subject_id, runs=run_ids)
 
     print(f"{subject_id=} {low_inflexion=}, {high_inflexion=}")
 
-    events = pd.DataFrame(
-        {'onset': times,
-         'trial_type': labels,
-         'duration': cfg.DURATION}
-    )
+    if cfg.FIT_PER_RUN:
+        sample_mask = dataset.run_sample_masks
+        events = [pd.DataFrame({'onset': t, 'trial_type': l, 'duration': cfg.DURATION}) for t, l in zip(times, labels)]
+    else:
+        sample_mask = dataset.sample_mask
+        events = pd.DataFrame(
+            {'onset': times,
+             'trial_type': labels,
+             'duration': cfg.DURATION}
+        )
+
+    if cfg.GLM_ENGINE == "native":
+        z_maps = native_z_maps(cfg, dataset, images, events, sample_mask, smoothing_fwhm,
+                               labels_col, low_inflexion, high_inflexion)
+    else:
+        z_maps = nilearn_z_maps(cfg, dataset, images, events, sample_mask, smoothing_fwhm,
+                                labels_col, low_inflexion, high_inflexion)
+
+    # keyed (subject, contrast), a ZMapStore writes each map to disk as it comes
+    if global_z_map is not None:
+        for name, z_score in z_maps.items():
+            global_z_map[(subject_id, name)] = z_score
 
+    return z_maps
+
+
+def nilearn_z_maps(cfg, dataset, images, events, sample_mask, smoothing_fwhm,
+                   labels_col, low_inflexion, high_inflexion):
     repetition_time = dataset.repetition_time
     fmri_glm = FirstLevelModel(t_r=repetition_time,
                                drift_model='polynomial',
                                drift_order=3,
                                hrf_model='spm',
                                mask_img=dataset.brain_mask,
-                               smoothing_fwhm=cfg.SMOOTHING_FWHM,
-                               n_jobs=-1)
+                               smoothing_fwhm=smoothing_fwhm,
+                               n_jobs=cfg.N_JOBS)
+
+    if cfg.FIT_PER_RUN:
+        design_matrices = [design.design_matrix(run_events, repetition_time, run_img.shape[3])
+                           for run_img, run_events in zip(images, events)]
+    else:
+        design_matrices = [design.design_matrix(events, repetition_time, images.shape[3])]
 
     if cfg.USE_SAMPLE_MASKS:
-        fmri_glm = fmri_glm.fit(images, events, sample_masks=sample_mask)
+        fmri_glm = fmri_glm.fit(images, design_matrices=design_matrices, sample_masks=sample_mask)
     else:
-        fmri_glm = fmri_glm.fit(images, events)
+        fmri_glm = fmri_glm.fit(images, design_matrices=design_matrices)
 
-    design_matrix = fmri_glm.design_matrices_[0]
+    layouts = [design_matrix.columns for design_matrix in fmri_glm.design_matrices_]
+    contrast_list = contrast_compiler.expressible(layouts, gen_contrast_list(cfg.PREDICTORS), labels_col,
+                                                  low_inflexion, high_inflexion)
 
-    contrast_matrix = np.eye(design_matrix.shape[1])
-    contrasts = {
-        str(column): contrast_matrix[i]
-        for i, column in enumerate(design_matrix.columns)
-    }
+    # one contrast matrix per run, the columns of each run design may differ
+    run_matrices = [contrast_compiler.contrast_matrix(design_matrix.columns, contrast_list, labels_col,
+                                                      low_inflexion, high_inflexion)
+                    for design_matrix in fmri_glm.design_matrices_]
 
-    if labels_col == "morph level":
-        parse_contrast(contrasts, low_inflexion, high_inflexion)
+    z_maps = {}
+    for i, contrast in enumerate(contrast_list):
 
-    for contrast in gen_contrast_list():
+        z_score = fmri_glm.compute_contrast([matrix[i] for matrix in run_matrices], output_type="z_score")
+        z_maps[contrast_name(contrast)] = z_score
 
-        glm_contrast_vector = np.sum(contrasts[column] for column in contrast["+"])
-        if '-' in contrast:
-            glm_contrast_vector -= np.sum(contrasts[column] for column in contrast["-"])
+    return z_maps
 
-        z_score = fmri_glm.compute_contrast(glm_contrast_vector, output_type="z_score")
-        name = contrast_name(contrast)
 
-        global_z_map[name].append(z_score)
+def native_z_maps(cfg, dataset, images, events, sample_mask, smoothing_fwhm,
+                  labels_col, low_inflexion, high_inflexion):
+    if not cfg.FIT_PER_RUN:
+        images, events, sample_mask = [images], [events], [sample_mask]
 
+    if not cfg.USE_SAMPLE_MASKS:
+        sample_mask = [None] * len(images)
+
+    mask_img = dataset.brain_mask
+    mask = np.asanyarray(mask_img.dataobj) > 0
+
+    run_designs = [design.design_matrix(run_events, dataset.repetition_time, run_img.shape[3], sample_mask=run_sample_mask)
+                   for run_img, run_events, run_sample_mask in zip(images, events, sample_mask)]
+    contrast_list = contrast_compiler.expressible([run_design.columns for run_design in run_designs],
+                                                  gen_contrast_list(cfg.PREDICTORS), labels_col,
+                                                  low_inflexion, high_inflexion)
+
+    combined = None
+    for run_img, run_design, run_sample_mask in zip(images, run_designs, sample_mask):
+        Y = smoothed_matrix(run_img, mask, smoothing_fwhm)
+
+        if run_sample_mask is not None:
+            Y = Y[run_sample_mask]
+
+        contrast_matrix = contrast_compiler.contrast_matrix(run_design.columns, contrast_list, labels_col,
+                                                            low_inflexion, high_inflexion)
+
+        run_contrasts = GLM().fit(Y, run_design.values).compute_contrasts(contrast_matrix)
+        combined = run_contrasts if combined is None else combined + run_contrasts
+
+    z_scores = combined.z_score()
+
+    return {contrast_name(contrast): unmask(z, mask_img) for contrast, z in zip(contrast_list, z_scores)}
 
-atlas = AtlasBrowser("AAL3")
 
 def get_regions(global_z_map, correction):
-    mni_regions = {}
+    """Atlas region ids of the cluster peaks of every z-map, per contrast."""
+    atlas = get_atlas("AAL3")
     alpha, method, cluster_size = correction
 
+    peaks = {}
     for c_name, images in global_z_map.items():
-        mni_regions[c_name] = []
+        peaks[c_name] = []
 
-        for z_score in images:
+        for z_score in images.values():
 
             clean, threshold = threshold_stats_img(z_score,
                                                    alpha=alpha,
@@ -151,36 +223,75 @@ def get_regions(global_z_map, correction):
 
             table = get_clusters_table(clean, stat_threshold=threshold, cluster_threshold=cluster_size)
 
-            pos = [np.array([x, y, z]) for (x, y, z) in zip(table['X'], table['Z'], table['Y'])]
+            peaks[c_name].append(table[['X', 'Y', 'Z']].to_numpy(dtype=np.float64))
+
+    # every peak of every subject and contrast projected in one pass
+    stacked = np.concatenate([p for c_peaks in peaks.values() for p in c_peaks] + [np.empty((0, 3))])
+    region_ids = atlas.find_nearest_regions(stacked, return_ids=True)
+
+    counts = np.cumsum([0] + [sum(len(p) for p in c_peaks) for c_peaks in peaks.values()])
+    return {c_name: region_ids[start:end] for c_name, start, end in zip(peaks, counts[:-1], counts[1:])}
 
-            for p in pos:
-                try:
-                    projected_coords = atlas.project_to_nearest(p)
-                    projected_regions = atlas.find_regions(projected_coords)
 
-                    mni_regions[c_name].append(*projected_regions)
-                except Exception as e:
-                    print(e)
+def thresholded_maps(images, correction):
+    """Data and affine of every thresholded z-map, one map at a time as the images are read from disk."""
+    alpha, method, cluster_size = correction
+
+    for z_score in images:
+        clean = threshold_stats_img(z_score,
+                                    alpha=alpha,
+                                    height_control=method,
+                                    cluster_threshold=cluster_size)[0]
+
+        yield np.asanyarray(clean.dataobj), clean.affine
+
+
+def region_overlap(global_z_map, correction):
+    """Voxel count, mean z and peak z per atlas region of every thresholded z-map, per subject."""
+    atlas = get_atlas("AAL3")
+    tables = []
 
-    return mni_regions
+    for c_name, images in global_z_map.items():
+
+        # summarised map by map, a single subject map is in memory at once
+        for subject, (data, affine) in zip(images, thresholded_maps(images.values(), correction)):
+            counts, means, peaks = (values[0] for values in atlas.region_overlap(data[np.newaxis], affine))
+
+            region = np.flatnonzero(counts)
+            if not len(region):
+                continue
 
+            tables.append(pd.DataFrame({
+                "contrast": c_name,
+                "subject": subject,
+                "region": [atlas._region_names.get(i, str(i)) for i in region],
+                "n_voxels": counts[region],
+                "mean_z": means[region],
+                "peak_z": peaks[region],
+            }))
 
-def plot_regions(cfg, mni_regions, correction, subject_ids):
-    mni_regions_concat = {}
+    columns = ["contrast", "subject", "region", "n_voxels", "mean_z", "peak_z"]
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=columns)
 
-    for k, v in mni_regions.items():
-        reg_list = np.array(v, dtype=object)
 
-        mni_regions_concat[k] = reg_list
+def region_counts(mni_regions):
+    """(region, contrast) table of the number of peaks, regions without any peak left out."""
+    atlas = get_atlas("AAL3")
+    n_regions = max([max(atlas._region_names)] + [ids.max() for ids in mni_regions.values() if len(ids)]) + 1
 
-    mni_df = pd.DataFrame(dict([(k, pd.Series(v)) for k, v in mni_regions_concat.items()]))
-    mni_summary = pd.DataFrame({
-        col.replace(' ', ''): mni_df[col].value_counts()
-        for col in mni_df.columns
-    })
+    # no contrast at all gives an empty (0, 0) table
+    counts = np.zeros((n_regions, len(mni_regions)), dtype=np.int64)
+    for j, ids in enumerate(mni_regions.values()):
+        counts[:, j] = np.bincount(ids, minlength=n_regions)
+    used = np.flatnonzero(counts.sum(axis=1))
 
-    mni_summary = mni_summary.fillna(0)
+    mni_summary = pd.DataFrame(counts[used],
+                               index=[atlas._region_names.get(i, str(i)) for i in used],
+                               columns=[c_name.replace(' ', '') for c_name in mni_regions])
+    return mni_summary.sort_index()
 
+
+def plot_regions(cfg, mni_summary, correction, subject_ids):
     fig, ax = plt.subplots(figsize=(18, 30))
     im = ax.imshow(mni_summary.values, cmap='Wistia', aspect='auto')
 
@@ -220,20 +331,22 @@ def path(cfg):
     return f"{cfg.SUBJECTS}_{cfg.CONFOUND_MODE}_{cfg.VOLUMES_OFFSET}_{mask_name}_{filtered}_{cfg.SMOOTHING_FWHM}_{dur}"
 
 
-def run(cfg):
+def get_subject_ids(cfg):
 
     subjects_ids_per_type = {
         "SCZ": set(range(27, 34)),
         "CONTROL": set(range(1, 27))
     }
 
-    subject_ids = subjects_ids_per_type[cfg.SUBJECTS]
+    subject_ids = set(subjects_ids_per_type[cfg.SUBJECTS])
 
     if cfg.EXCLUDE_WITH_SIGMOID:
         subject_ids -= exclude_with_sigmoid(subject_ids)
 
-    skipped = []
+    return subject_ids
 
+
+def get_predictors(cfg):
     labels_col = "morph level"
     morph_response = False
 
@@ -242,71 +355,121 @@ def run(cfg):
     elif cfg.PREDICTORS == "response":
         labels_col = "response"
 
-    global_z_map = defaultdict(list)
+    return labels_col, morph_response
 
-    for subject in subject_ids:
 
-        try:
-            GLM_contrast_map(cfg, global_z_map, subject, labels_col, morph_response)
-        except Exception as e:
-            print("Skipping subject ", subject)
-            print(e)
-            skipped.append(subject)
-        continue
+def contrast_path(cfg, subject, c_name):
+    fname = c_name.replace(' ', '_').replace('>', 'over')
+
+    return f"brute_force/{path(cfg)}/contrasts/sub-{subject}-{fname}.nii.gz"
+
+
+def subjects_with_maps(cfg, subjects, contrasts):
+    """Subjects having a saved map of every contrast, a fit leaving out the contrasts its design cannot express."""
+    return sorted(s for s in subjects if all(os.path.exists(contrast_path(cfg, s, c_name)) for c_name in contrasts))
+
+
+def save_z_maps(cfg, subject, z_maps):
+    os.makedirs(f"brute_force/{path(cfg)}/contrasts/", exist_ok=True)
+
+    for c_name, z_score in z_maps.items():
+        # written aside then renamed, an interrupted run never leaves a truncated map
+        target = contrast_path(cfg, subject, c_name)
+        tmp_path = f"{target[:-len('.nii.gz')]}.{os.getpid()}.tmp.nii.gz"
+
+        nibabel.save(z_score, tmp_path)
+        os.replace(tmp_path, target)
+
+
+class ZMapStore:
+    """(subject, contrast) -> z-map of a configuration, backed by the files of save_z_maps.
+
+    Maps are written when they are set and read back lazily, so a run never
+    holds more than one subject's maps in memory.
+    """
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self._keys = {}
+
+    def __setitem__(self, key, z_score):
+        subject, c_name = key
+        save_z_maps(self.cfg, subject, {c_name: z_score})
+        self._keys[key] = None
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+
+        subject, c_name = key
+        return nibabel.load(contrast_path(self.cfg, subject, c_name))
+
+    def __contains__(self, key):
+        return key in self._keys
 
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def subjects(self):
+        return sorted({subject for subject, _ in self._keys})
+
+    @property
+    def contrasts(self):
+        return list(dict.fromkeys(c_name for _, c_name in self._keys))
+
+    def by_contrast(self):
+        """contrast -> {subject: map} of the subjects having it, in subject order, as get_regions expects."""
+        return {c_name: {subject: self[(subject, c_name)] for subject in self.subjects if (subject, c_name) in self}
+                for c_name in self.contrasts}
+
+
+def save_regions(cfg, global_z_map, subject_ids):
     filepath = path(cfg)
 
     os.makedirs(f"brute_force/{filepath}/regions/", exist_ok=True)
-    os.makedirs(f"brute_force/{filepath}/contrasts/", exist_ok=True)
 
     for correction in cfg.CORRECTIONS:
 
-        mni_regions = get_regions(global_z_map, correction)
-        plot_regions(cfg, mni_regions, correction, subject_ids)
+        mni_summary = region_counts(get_regions(global_z_map, correction))
+        plot_regions(cfg, mni_summary, correction, subject_ids)
 
         cor_name = '_'.join(str(c) for c in correction).replace('0.', "p")
 
-        plt.savefig(f"brute_force/{filepath}/regions/{cor_name}.png")
-
-    z_map_subjects = subject_ids - set(skipped)
-    for c_name, images in global_z_map.items():
-        for z_score, subject in zip(images, z_map_subjects):
-
-            fname = c_name.replace(' ', '_').replace('>', 'over')
-
-            nibabel.save(z_score, f"brute_force/{filepath}/contrasts/sub-{subject}-{fname}.nii.gz")
+        region_overlap(global_z_map, correction).to_csv(f"brute_force/{filepath}/regions/{cor_name}.csv", index=False)
 
+        plt.savefig(f"brute_force/{filepath}/regions/{cor_name}.png")
+        plt.close()
 
-if __name__ == '__main__':
 
-    from itertools import product
-    import pickle
+def run(cfg):
 
-    cf_mode = ['full', 'reduced']
-    masks = [True, False]
-    smoothing = [3, 5, 7]
-    duration = [2.5, 5, 7.5]
+    subject_ids = sorted(get_subject_ids(cfg))
 
-    todo = set(product(cf_mode, masks, smoothing, duration))
+    labels_col, morph_response = get_predictors(cfg)
 
-    with open("cache.pkl", "rb") as f:
-        done = pickle.load(f)
+    z_maps = ZMapStore(cfg)
 
-    todo -= done
+    for subject in subject_ids:
 
-    cfg = Config()
+        try:
+            GLM_contrast_map(cfg, z_maps, subject, labels_col, morph_response)
+        except Exception as e:
+            print("Skipping subject ", subject)
+            print(e)
 
-    for combination in todo:
+    save_regions(cfg, z_maps.by_contrast(), subject_ids)
 
-        cfg.CONFOUND_MODE = combination[0]
-        cfg.USE_SAMPLE_MASKS = combination[1]
-        cfg.SMOOTHING_FWHM = combination[2]
-        cfg.DURATION = combination[3]
 
-        run(cfg)
+if __name__ == '__main__':
 
-        done.add(combination)
+    import sweep
 
-        with open("cache.pkl", "wb") as f:
-            pickle.dump(done, f)
+    grid = {
+        "CONFOUND_MODE": ['full', 'reduced'],
+        "USE_SAMPLE_MASKS": [True, False],
+        "SMOOTHING_FWHM": [3, 5, 7],
+        "DURATION": [2.5, 5, 7.5],
+    }
 
+    sweep.run_sweep(Config(), grid)
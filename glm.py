@@ -0,0 +1,182 @@
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+from scipy import stats as sps
+from scipy.linalg import pinv
+
+from nilearn import image
+
+
+# (design hash, rho) -> (whitened design, pseudo-inverse, normalized covariance)
+_pinv_cache = OrderedDict()
+PINV_CACHE_SIZE = 512
+
+TINY = 1e-50
+
+
+def design_key(X):
+    X = np.ascontiguousarray(X, dtype=np.float64)
+    return hashlib.sha1(X.tobytes() + str(X.shape).encode()).hexdigest()
+
+
+def whiten(X, rho):
+    # AR(1) prewhitening, same convention as nilearn's ARModel
+    whitened = np.array(X, dtype=np.float64)
+    if rho:
+        whitened[1:] -= rho * np.asarray(X, dtype=np.float64)[:-1]
+    return whitened
+
+
+def whitened_pinv(X, rho=0.0, key=None):
+    if key is None:
+        key = design_key(X)
+
+    cache_key = (key, float(rho))
+    if cache_key in _pinv_cache:
+        _pinv_cache.move_to_end(cache_key)
+        return _pinv_cache[cache_key]
+
+    whitened = whiten(X, rho)
+    calc_beta = pinv(whitened)
+    entry = (whitened, calc_beta, calc_beta @ calc_beta.T)
+
+    _pinv_cache[cache_key] = entry
+    if len(_pinv_cache) > PINV_CACHE_SIZE:
+        _pinv_cache.popitem(last=False)
+
+    return entry
+
+
+def mean_scaling(Y):
+    # percent signal change, as FirstLevelModel(signal_scaling=0)
+    mean = np.maximum(Y.mean(axis=0), 1)
+    return 100 * (Y / mean - 1)
+
+
+def ar1_coefficients(residuals, bins=100):
+    # Yule-Walker on the OLS residuals, binned like nilearn.glm.first_level.run_glm
+    n = residuals.shape[0]
+    centered = residuals - residuals.mean()
+
+    r0 = np.einsum("tv,tv->v", centered, centered) / (n * n)
+    r1 = np.einsum("tv,tv->v", centered[1:], centered[:-1]) / ((n - 1) * n)
+
+    rho = np.divide(r1, r0, out=np.zeros_like(r0), where=r0 != 0)
+    return (rho * bins).astype(int) / bins
+
+
+def smoothed_matrix(img, mask, fwhm=None):
+    """(n_timepoints, n_voxels) matrix of `img` inside `mask`, smoothed on the full grid first."""
+    if fwhm:
+        img = image.smooth_img(img, fwhm)
+
+    data = np.asanyarray(img.dataobj)
+    return np.ascontiguousarray(data[mask].T, dtype=np.float64)
+
+
+class GLM:
+    """First-level GLM solved for every voxel of a (n_timepoints, n_voxels) matrix at once.
+
+    Mirrors nilearn's FirstLevelModel(noise_model='ar1', signal_scaling=0):
+    an OLS fit gives the voxelwise AR(1) coefficients, voxels are grouped by
+    binned coefficient and each group is refitted on the prewhitened data
+    with a single matrix product. Pseudo-inverses are cached per design and
+    AR coefficient, so fits sharing a design (parameter sweeps, subjects with
+    the same timing) only pay for the products.
+    """
+
+    def __init__(self, noise_model="ar1", bins=100, signal_scaling=True):
+        if noise_model not in ("ar1", "ols"):
+            raise ValueError(f"Unsupported noise model {noise_model=}, expected 'ar1' or 'ols'")
+
+        self.noise_model = noise_model
+        self.bins = bins
+        self.signal_scaling = signal_scaling
+
+        self.beta_ = None
+        self.dispersion_ = None
+        self.labels_ = None
+        self.rho_ = None
+        self.normalized_cov_ = None
+        self.dof_ = None
+
+    def fit(self, Y, X):
+        Y = np.asarray(Y, dtype=np.float64)
+        X = np.asarray(X, dtype=np.float64)
+
+        if Y.shape[0] != X.shape[0]:
+            raise ValueError(f"Y and X must have the same number of rows, got {Y.shape} and {X.shape}")
+
+        if self.signal_scaling:
+            Y = mean_scaling(Y)
+
+        key = design_key(X)
+        n_samples, n_regressors = X.shape
+
+        eps = np.abs(X).sum() * np.finfo(np.float64).eps
+        self.dof_ = n_samples - np.linalg.matrix_rank(X, eps)
+
+        whitened, calc_beta, _ = whitened_pinv(X, 0.0, key)
+        beta = calc_beta @ Y
+
+        if self.noise_model == "ols":
+            rho = np.zeros(Y.shape[1])
+        else:
+            rho = ar1_coefficients(Y - whitened @ beta, self.bins)
+
+        self.rho_, self.labels_ = np.unique(rho, return_inverse=True)
+        self.beta_ = np.empty((n_regressors, Y.shape[1]))
+        self.dispersion_ = np.empty(Y.shape[1])
+        self.normalized_cov_ = np.empty((len(self.rho_), n_regressors, n_regressors))
+
+        for label, value in enumerate(self.rho_):
+            voxels = self.labels_ == label
+
+            whitened, calc_beta, normalized_cov = whitened_pinv(X, value, key)
+            wY = whiten(Y[:, voxels], value)
+
+            beta = calc_beta @ wY
+            residuals = wY - whitened @ beta
+
+            self.beta_[:, voxels] = beta
+            self.dispersion_[voxels] = np.einsum("tv,tv->v", residuals, residuals) / (n_samples - n_regressors)
+            self.normalized_cov_[label] = normalized_cov
+
+        return self
+
+    def compute_contrasts(self, contrast_matrix):
+        """Effects and variances of the (n_contrasts, n_regressors) `contrast_matrix` rows."""
+        C = np.atleast_2d(np.asarray(contrast_matrix, dtype=np.float64))
+
+        effect = C @ self.beta_
+        # c' cov c for every contrast and AR group, broadcast to the voxels of the group
+        cvc = np.einsum("qp,lpr,qr->lq", C, self.normalized_cov_, C)
+        variance = cvc[self.labels_].T * self.dispersion_
+
+        return Contrasts(effect, variance, self.dof_)
+
+
+class Contrasts:
+    """Stack of t contrasts, shape (n_contrasts, n_voxels)."""
+
+    def __init__(self, effect, variance, dof):
+        self.effect = effect
+        self.variance = variance
+        self.dof = dof
+
+    def __add__(self, other):
+        # fixed effects across runs, as nilearn's compute_fixed_effect_contrast
+        return Contrasts(self.effect + other.effect, self.variance + other.variance, self.dof + other.dof)
+
+    def stat(self):
+        return self.effect / np.sqrt(np.maximum(self.variance, TINY))
+
+    def z_score(self):
+        t = self.stat()
+
+        p_value = np.clip(sps.t.sf(t, self.dof), 1e-300, 1 - 1e-16)
+        one_minus_p = np.clip(sps.t.cdf(t, self.dof), 1e-300, 1 - 1e-16)
+
+        z = sps.norm.isf(p_value)
+        return np.where(z < 0, sps.norm.ppf(one_minus_p), z)
@@ -0,0 +1,74 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+label_dtypes = {
+    "run": np.int64,
+    "trial": np.int64,
+    "global time": np.int64,
+    "run time": np.int64,
+    "morph level": np.int64,
+    "couple": np.int64,
+    "response": np.int64,
+    "response time": np.float64,
+}
+
+
+# (path) -> (size, mtime, parsed), shared by every MRI / Subject of the process
+_index = {}
+
+
+def _stat(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _cached(path, parse):
+    stat = _stat(path)
+
+    entry = _index.get(path)
+    if entry is None or entry[:2] != stat:
+        entry = (*stat, parse(path))
+        _index[path] = entry
+
+    return entry[2]
+
+
+def _parse_labels(path):
+    labels = pd.read_csv(path, dtype=label_dtypes)
+    return {run: run_labels for run, run_labels in labels.groupby("run", sort=True)}
+
+
+def _parse_couples(path):
+    with open(path) as f:
+        couples_data = f.readlines()
+    return frozenset(int(float(line.strip())) for line in couples_data if line.strip())
+
+
+def labels_path(folder, subject_id):
+    return f"{folder}/labels/labels_{subject_id}.csv"
+
+
+def exclusion_path(folder, subject_id):
+    return f"{folder}/labels/exclusion/couples_{subject_id}.csv"
+
+
+def run_labels(folder, subject_id, run_id):
+    """Labels of one run, the subject file being read once and grouped by run."""
+    runs = _cached(labels_path(folder, subject_id), _parse_labels)
+
+    if run_id not in runs:
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in label_dtypes.items()})
+
+    return runs[run_id]
+
+
+def subject_labels(folder, subject_id):
+    runs = _cached(labels_path(folder, subject_id), _parse_labels)
+    return pd.concat(runs.values())
+
+
+def excluded_couples(folder, subject_id):
+    return _cached(exclusion_path(folder, subject_id), _parse_couples)
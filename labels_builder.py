@@ -0,0 +1,340 @@
+"""Label tables of every subject, built from its raw Cogent log in one pass.
+
+`labels/raw/labels_{sub}.csv` is streamed line by line through a small state
+machine which emits
+
+- the morph table `labels/labels_{sub}.csv`, one row per presented morph,
+- the motor table `labels/motor/labels_{sub}.csv`, the response screens of
+  the last run,
+- the excluded couples `labels/exclusion/couples_{sub}.csv`, the couples
+  whose own sigmoid does not separate the morph levels.
+
+Subjects are built in parallel and only when their raw log changed since
+the last build, as recorded in `cache/labels/manifest.json`. Tables already
+on disk and not built yet are compared with the rebuilt ones first, and are
+only replaced with `force` when they differ.
+"""
+import os
+import csv
+import json
+import argparse
+import warnings
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy.optimize import curve_fit, OptimizeWarning
+
+import run_cache
+import label_store
+from stats import sigmoid
+
+
+MORPH_COLUMNS = list(label_store.label_dtypes)
+MOTOR_COLUMNS = ["response", "response time"]
+
+COUPLES = range(1, 10)
+
+# added to the button delay logged after the morph, as the original labels
+RESPONSE_OFFSET = 500
+
+
+def raw_path(folder, subject_id):
+    return f"{folder}/labels/raw/labels_{subject_id}.csv"
+
+
+def motor_path(folder, subject_id):
+    return f"{folder}/labels/motor/labels_{subject_id}.csv"
+
+
+def manifest_path(folder):
+    return f"{folder}/cache/labels/manifest.json"
+
+
+def _time(line):
+    return int(line.split(",", 1)[0])
+
+
+def _text(line):
+    # time,[delta],:,text,...
+    return line.split(",", 4)[3]
+
+
+def parse(path):
+    """Morph rows and motor rows of a raw log, from a single pass over its lines.
+
+    Runs start at "Debut_run". A morph lasts until the next morph or run,
+    the last "bouton_1" within it being the response. Motor rows are the
+    "image croix" screens of a run showing an "image response", the screen
+    still open at "Fin_run" being dropped; the last finished run is kept.
+    """
+    morph_rows, motor_rows = [], []
+
+    run = 0
+    trial = None
+    in_run = False
+    sync = None
+    screen = None
+    run_motor = []
+
+    with open(path) as f:
+        for line in f:
+            if "Debut_run " in line:
+                if trial is not None:
+                    morph_rows.append(trial)
+                run, n_trials, trial = run + 1, 0, None
+                in_run, sync, screen, run_motor = True, None, None, []
+
+            elif not run:
+                continue
+
+            elif "Fin_run" in line:
+                if in_run:
+                    motor_rows = run_motor
+                in_run, screen = False, None
+
+            elif "Synchro_IRM" in line:
+                if sync is None:
+                    sync = _time(line)
+
+            elif "MORPH" in line:
+                if trial is not None:
+                    morph_rows.append(trial)
+
+                # image Morphs_IRM\MORPH_15_PERCENT_FAMILIARITY\morph_15_4.BMP 35172
+                _, image, onset = _text(line).split(" ")[:3]
+                _, level, couple = image.split("\\")[2].split(".")[0].split("_")[:3]
+
+                n_trials += 1
+                trial = [run, n_trials, int(onset), int(onset) - sync, int(level), int(couple), 0, None]
+
+            elif "bouton_" in line:
+                if trial is not None and "bouton_1" in line:
+                    trial[6:] = [1, int(_text(line).split(" ")[1]) + RESPONSE_OFFSET]
+                if screen is not None:
+                    screen["button"] = True
+
+            elif "image croix" in line:
+                if in_run:
+                    if screen is not None and screen["response"] is not None:
+                        run_motor.append([int(screen["button"]), screen["response"] - sync])
+                    screen = {"response": None, "button": False}
+
+            elif "image response" in line:
+                if screen is not None and screen["response"] is None:
+                    screen["response"] = _time(line)
+
+    if trial is not None:
+        morph_rows.append(trial)
+
+    return morph_rows, motor_rows
+
+
+def excluded_couples(morph_rows):
+    """Couples whose sigmoid, fitted on their own responses, is flat (< 0.25 over the morph) or off the scale."""
+    labels = pd.DataFrame(morph_rows, columns=MORPH_COLUMNS)
+    xdata = np.linspace(5, 95, 10)
+
+    excluded = []
+    for couple in COUPLES:
+        rows = labels[labels["couple"] == couple]
+        ydata = np.nan_to_num(rows.groupby("morph level", sort=True)["response"].mean().to_numpy(dtype=np.float64))
+
+        # a couple missing a morph level cannot be fitted, and is excluded
+        try:
+            with np.errstate(over="ignore"), warnings.catch_warnings():
+                warnings.simplefilter("ignore", OptimizeWarning)
+                popt, _ = curve_fit(sigmoid, xdata, ydata, [max(ydata), np.median(xdata), 1, min(ydata)], maxfev=5000)
+        except Exception:
+            popt = [0, 0, 0, 0]
+
+        with np.errstate(over="ignore"):
+            spread = sigmoid(95, *popt) - sigmoid(5, *popt)
+        if not (popt[1] < 100 and spread > 0.25):
+            excluded.append(couple)
+
+    return excluded
+
+
+def tables(folder, subject_id):
+    """Morph, motor and excluded couples tables of a subject, as written to disk."""
+    morph_rows, motor_rows = parse(raw_path(folder, subject_id))
+    return morph_rows, motor_rows, excluded_couples(morph_rows)
+
+
+def _write_csv(path, header, rows):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(header)
+        writer.writerows(rows)
+    os.replace(tmp_path, path)
+
+
+def _write_couples(path, couples):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    np.savetxt(tmp_path, couples)
+    os.replace(tmp_path, path)
+
+
+def table_paths(folder, subject_id):
+    return (label_store.labels_path(folder, subject_id), motor_path(folder, subject_id),
+            label_store.exclusion_path(folder, subject_id))
+
+
+def build_subject(folder, subject_id, overwrite=True):
+    """Write the tables of a subject, only the missing ones unless `overwrite`."""
+    morph_rows, motor_rows, couples = tables(folder, subject_id)
+    morph_path, motor_table_path, couples_path = table_paths(folder, subject_id)
+
+    for path in (morph_path, motor_table_path, couples_path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if overwrite or not os.path.exists(morph_path):
+        _write_csv(morph_path, MORPH_COLUMNS, morph_rows)
+    if overwrite or not os.path.exists(motor_table_path):
+        _write_csv(motor_table_path, MOTOR_COLUMNS, motor_rows)
+    if overwrite or not os.path.exists(couples_path):
+        _write_couples(couples_path, couples)
+
+    return subject_id, run_cache.source_stat(raw_path(folder, subject_id))
+
+
+def _read_couples(path):
+    with warnings.catch_warnings():
+        # nothing excluded, empty file
+        warnings.simplefilter("ignore", UserWarning)
+        return sorted(int(couple) for couple in np.loadtxt(path, ndmin=1))
+
+
+def check_subject(folder, subject_id, tolerance=30):
+    """Differences between the tables rebuilt from the raw log and the ones on disk, as the scratch `cmp` checks.
+
+    Run times may differ by `tolerance` ms, every other column must match.
+    """
+    morph_rows, motor_rows, couples = tables(folder, subject_id)
+    problems = []
+
+    if os.path.exists(label_store.labels_path(folder, subject_id)):
+        rebuilt = pd.DataFrame(morph_rows, columns=MORPH_COLUMNS)
+        origin = pd.read_csv(label_store.labels_path(folder, subject_id))
+        if len(rebuilt) != len(origin):
+            problems.append(f"{len(rebuilt)} morph rows rebuilt, {len(origin)} on disk")
+        else:
+            exact = [col for col in MORPH_COLUMNS if col != "run time"]
+            differ = [col for col in exact
+                      if not np.array_equal(rebuilt[col].to_numpy(dtype=np.float64), origin[col].to_numpy(dtype=np.float64),
+                                            equal_nan=True)]
+            if differ:
+                problems.append(f"morph columns {differ} differ")
+            if (np.abs(rebuilt["run time"] - origin["run time"]) >= tolerance).any():
+                problems.append(f"morph run times differ by {tolerance} ms or more")
+
+    if os.path.exists(motor_path(folder, subject_id)):
+        origin = pd.read_csv(motor_path(folder, subject_id)).to_numpy()
+        if not np.array_equal(np.asarray(motor_rows).reshape(-1, 2), origin):
+            problems.append(f"motor table differs ({len(motor_rows)} rows rebuilt, {len(origin)} on disk)")
+
+    if os.path.exists(label_store.exclusion_path(folder, subject_id)):
+        origin = _read_couples(label_store.exclusion_path(folder, subject_id))
+        if couples != origin:
+            problems.append(f"excluded couples {couples} rebuilt, {origin} on disk")
+
+    return subject_id, problems
+
+
+def read_manifest(folder):
+    try:
+        with open(manifest_path(folder)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(folder, manifest):
+    path = manifest_path(folder)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def subjects(folder):
+    names = os.listdir(f"{folder}/labels/raw")
+    return sorted(int(name[len("labels_"):-len(".csv")]) for name in names if name.startswith("labels_"))
+
+
+def _map(function, subject_ids, workers):
+    if workers == 1 or len(subject_ids) <= 1:
+        return [function(subject) for subject in subject_ids]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(function, subject_ids))
+
+
+def build(folder=".", subject_ids=None, workers=None, force=False):
+    """Rebuild the tables of the subjects whose raw log changed since the last build, in parallel.
+
+    Subjects missing from the manifest whose tables are already on disk are
+    checked instead of rebuilt: matching tables are kept, only the missing
+    ones being written, and differing tables are left as they are unless
+    `force`. Returns the rebuilt subjects and the differences of the
+    subjects left as they are.
+    """
+    subject_ids = subjects(folder) if subject_ids is None else sorted(subject_ids)
+    manifest = read_manifest(folder)
+
+    stale = [subject for subject in subject_ids
+             if force or manifest.get(str(subject)) != run_cache.source_stat(raw_path(folder, subject))]
+
+    # tables the builder did not write, e.g. the shipped ones, are never silently replaced
+    existing = [subject for subject in stale if not force and str(subject) not in manifest
+                and any(os.path.exists(path) for path in table_paths(folder, subject))]
+    differences = {subject: problems for subject, problems in _map(partial(check_subject, folder), existing, workers)
+                   if problems}
+
+    validated = [subject for subject in existing if subject not in differences]
+    rebuilt = [subject for subject in stale if subject not in existing]
+
+    built = (_map(partial(build_subject, folder, overwrite=False), validated, workers)
+             + _map(partial(build_subject, folder), rebuilt, workers))
+    for subject, source in built:
+        manifest[str(subject)] = source
+
+    write_manifest(folder, manifest)
+    return rebuilt, differences
+
+
+def check(folder=".", subject_ids=None, workers=None):
+    """subject -> differences between the rebuilt and the existing tables, subjects without any left out."""
+    subject_ids = subjects(folder) if subject_ids is None else sorted(subject_ids)
+    return {subject: problems for subject, problems in _map(partial(check_subject, folder), subject_ids, workers)
+            if problems}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Build the label tables from the raw task logs.")
+    parser.add_argument("--folder", default=".")
+    parser.add_argument("--subjects", type=int, nargs="+", default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--check", action="store_true", help="only compare with the existing tables")
+    parser.add_argument("--force", action="store_true", help="rebuild every subject, replacing the tables that differ")
+    args = parser.parse_args()
+
+    if args.check:
+        differences = check(args.folder, args.subjects, args.workers)
+        for subject, problems in differences.items():
+            print(f"sub-{subject}: {'; '.join(problems)}")
+        print(f"{len(differences)} subjects differ")
+    else:
+        rebuilt, differences = build(args.folder, args.subjects, args.workers, args.force)
+        print(f"{len(rebuilt)} subjects rebuilt: {rebuilt}")
+
+        for subject, problems in differences.items():
+            print(f"sub-{subject} kept, its tables differ from the raw log: {'; '.join(problems)}")
+        if differences:
+            print("Run with --force to replace them")
@@ -1,11 +1,13 @@
 """Class for converting MNI coordinates to atlas regions."""
 
 import os
+from typing import Union
 
 import nibabel as nib
 import numpy as np
 import matplotlib
 from matplotlib import pyplot as plt
+from scipy.ndimage import distance_transform_edt
 
 _ATLASES_PATH = "./lib"
 _SUPPORTED_ATLASES = ["AAL3"]
@@ -28,6 +30,12 @@ class AtlasBrowser:  # noqa: D414
     find_regions
         Find the regions associated with MNI coordinates for the atlas.
 
+    find_nearest_regions
+        Find the regions of the nearest defined voxels of MNI coordinates.
+
+    region_overlap
+        Summarise the non-zero voxels of images per atlas region.
+
     Notes
     -----
     References:
@@ -39,12 +47,15 @@ class AtlasBrowser:  # noqa: D414
     _plotting_ready: bool = False
 
     _image: np.ndarray = None
+    _nearest: np.ndarray = None
+    _resampled: dict = None
     _plotting_image: np.ndarray = None
     _affine: np.ndarray = None
     _region_names: dict = None
 
-    def __init__(self, atlas: str) -> None:  # noqa: D107
+    def __init__(self, atlas: str, atlases_path: str = None) -> None:  # noqa: D107
         self.atlas_name = atlas
+        self.atlases_path = atlases_path or _ATLASES_PATH
 
         self._check_atlas()
         self._load_data()
@@ -59,16 +70,38 @@ class AtlasBrowser:  # noqa: D414
 
     def _load_data(self) -> None:
         """Load the atlas and accompanying information."""
-        self._path = os.path.join(_ATLASES_PATH, self.atlas_name)
+        self._path = os.path.join(self.atlases_path, self.atlas_name)
         self._load_atlas()
         self._load_regions()
 
     def _load_atlas(self) -> None:
-        """Load the atlas' nifti file."""
+        """Load the atlas' nifti file.
+
+        The labels are decoded once into the smallest unsigned dtype holding
+        them and persisted next to the atlas as `<atlas>_labels.npy`. The
+        volume is memory-mapped from that file, so processes using the same
+        atlas share its pages instead of each holding a decoded copy.
+        """
         atlas = nib.load(self._path + ".nii")
-        self._image = np.array(atlas.get_fdata(), dtype=np.int32)
         self._affine = atlas.affine
 
+        path = self._path + "_labels.npy"
+        if self._outdated(path):
+            labels = np.asanyarray(atlas.dataobj)
+            dtype = np.uint8 if labels.max() <= np.iinfo(np.uint8).max else np.uint16
+
+            tmp_path = f"{self._path}_labels.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, labels.astype(dtype))
+            os.replace(tmp_path, path)
+
+        self._image = np.load(path, mmap_mode="r")
+
+    def _outdated(self, path: str) -> bool:
+        """Whether the file derived from the atlas at `path` must be rebuilt."""
+        return not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(
+            self._path + ".nii"
+        )
+
     def _load_regions(self) -> None:
         """Load the regions' IDs, names, and colour groups for the atlas."""
         self._region_names = {0: "Undefined"}
@@ -93,22 +126,19 @@ class AtlasBrowser:  # noqa: D414
         -------
         projected_coordinates : numpy.ndarray, shape (3, ) or (n, 3)
             The projected MNI coordinates.
+
+        Notes
+        -----
+        The projection is a lookup in a precomputed index of the nearest
+        defined voxel (see `_nearest_index`), only coordinates outside of the
+        atlas grid are searched exhaustively. When several defined voxels are
+        equally close, the one picked may differ from a brute-force search.
         """
         coordinates, coordinates_ndim = self._sort_coordinates(coordinates)
         mni_coords = coordinates.astype(np.int32)  # round to ints
         atlas_coords = self._convert_mni_to_atlas_space(mni_coords)
 
-        projected_atlas_coords = []
-        defined_coords = np.argwhere(self._image != 0)
-        for coord in atlas_coords:
-            if self._image[coord[0], coord[1], coord[2]] != 0:
-                projected_atlas_coords.append(coord)
-            else:
-                nearest_coord_idx = np.argmin(
-                    np.linalg.norm(coord[np.newaxis, :] - defined_coords, axis=1)
-                )
-                projected_atlas_coords.append(defined_coords[nearest_coord_idx])
-        projected_atlas_coords = np.array(projected_atlas_coords)
+        projected_atlas_coords = self._project_to_nearest(atlas_coords)
 
         projected_mni_coords = self._convert_atlas_to_mni_space(projected_atlas_coords)
         if coordinates_ndim == 1:
@@ -116,6 +146,72 @@ class AtlasBrowser:  # noqa: D414
 
         return projected_mni_coords
 
+    def _project_to_nearest(self, atlas_coords: np.ndarray) -> np.ndarray:
+        """Project atlas coordinates to the nearest defined voxel.
+
+        Parameters
+        ----------
+        atlas_coords : numpy.ndarray, shape (n, 3)
+            Coordinates in the atlas space.
+
+        Returns
+        -------
+        projected_atlas_coords : numpy.ndarray, shape (n, 3)
+            Coordinates of the nearest defined voxels in the atlas space.
+        """
+        inside = np.all(
+            (atlas_coords >= 0) & (atlas_coords < self._image.shape), axis=1
+        )
+        projected_atlas_coords = np.empty_like(atlas_coords)
+
+        nearest = self._nearest_index[
+            atlas_coords[inside, 0], atlas_coords[inside, 1], atlas_coords[inside, 2]
+        ]
+        projected_atlas_coords[inside] = np.column_stack(
+            np.unravel_index(nearest, self._image.shape)
+        )
+
+        # coordinates outside of the atlas grid are not in the index
+        if not inside.all():
+            defined_coords = np.argwhere(self._image != 0)
+            for i in np.flatnonzero(~inside):
+                nearest_coord_idx = np.argmin(
+                    np.linalg.norm(atlas_coords[i] - defined_coords, axis=1)
+                )
+                projected_atlas_coords[i] = defined_coords[nearest_coord_idx]
+
+        return projected_atlas_coords
+
+    @property
+    def _nearest_index(self) -> np.ndarray:
+        """Flat index of the nearest defined voxel, for every voxel of the atlas.
+
+        The index volume is built once with a Euclidean distance transform
+        and persisted next to the atlas as `<atlas>_nearest.npy`, it is
+        rebuilt when the atlas file is newer.
+
+        Returns
+        -------
+        nearest : numpy.ndarray, shape of the atlas
+            Memory-mapped volume of flat indices into the atlas image.
+        """
+        if self._nearest is None:
+            path = self._path + "_nearest.npy"
+
+            if self._outdated(path):
+                indices = distance_transform_edt(
+                    self._image == 0, return_distances=False, return_indices=True
+                )
+                nearest = np.ravel_multi_index(indices, self._image.shape)
+
+                tmp_path = f"{self._path}_nearest.{os.getpid()}.tmp.npy"
+                np.save(tmp_path, nearest.astype(np.int32))
+                os.replace(tmp_path, path)
+
+            self._nearest = np.load(path, mmap_mode="r")
+
+        return self._nearest
+
     def find_regions(self, coordinates: np.ndarray, plot: bool = False) -> list[str]:
         """Find the regions associated with MNI coordinates for the atlas.
 
@@ -157,6 +253,154 @@ class AtlasBrowser:  # noqa: D414
 
         return regions
 
+    def find_nearest_regions(
+        self, coordinates: np.ndarray, return_ids: bool = False
+    ) -> Union[list[str], np.ndarray]:
+        """Find the regions of the nearest defined voxels of MNI coordinates.
+
+        Equivalent to `find_regions(project_to_nearest(coordinates))`, in a
+        single vectorised pass over all the coordinates, e.g. the peaks of the
+        cluster tables of every subject and contrast stacked together.
+
+        Parameters
+        ----------
+        coordinates : numpy.ndarray, shape (3, ) or (n, 3)
+            MNI coordinates (in mm) to find the associated atlas regions for,
+            given as an (n x 3) matrix where n is the number of coordinate
+            sets to find regions for, and 3 the x-, y-, and z-axis coordinates,
+            respectively.
+
+        return_ids : bool (default False)
+            Whether to return the region IDs instead of their names.
+
+        Returns
+        -------
+        regions : list of str or numpy.ndarray, shape (n, )
+            Names (or IDs) of the regions nearest to `coordinates`.
+        """
+        coordinates, _ = self._sort_coordinates(coordinates)
+        mni_coords = coordinates.astype(np.int32)  # round to ints
+        atlas_coords = self._project_to_nearest(
+            self._convert_mni_to_atlas_space(mni_coords)
+        )
+
+        region_ids = np.asarray(
+            self._image[atlas_coords[:, 0], atlas_coords[:, 1], atlas_coords[:, 2]]
+        )
+        if return_ids:
+            return region_ids
+
+        return [self._region_names[region_id] for region_id in region_ids]
+
+    def resample_labels(self, affine: np.ndarray, shape: tuple) -> np.ndarray:
+        """Resample the atlas labels onto another voxel grid.
+
+        Parameters
+        ----------
+        affine : numpy.ndarray, shape (4, 4)
+            Voxel to MNI affine of the target grid.
+
+        shape : tuple of int
+            Spatial shape of the target grid.
+
+        Returns
+        -------
+        labels : numpy.ndarray, shape `shape`
+            Region ID of every target voxel, by nearest neighbour; voxels
+            falling outside of the atlas are 0.
+
+        Notes
+        -----
+        The resampled labels are cached per target grid, so every image in
+        the same functional space reuses them.
+        """
+        if self._resampled is None:
+            self._resampled = {}
+
+        affine = np.asarray(affine, dtype=np.float64)
+        shape = tuple(int(s) for s in shape[:3])
+        key = (affine.tobytes(), shape)
+
+        if key not in self._resampled:
+            vox_to_atlas = np.linalg.solve(self._affine, affine)
+            target_coords = np.indices(shape).reshape(3, -1).T
+            atlas_coords = np.rint(
+                target_coords @ vox_to_atlas[:3, :3].T + vox_to_atlas[:3, 3]
+            ).astype(np.int32)
+
+            inside = np.all(
+                (atlas_coords >= 0) & (atlas_coords < self._image.shape), axis=1
+            )
+            labels = np.zeros(len(atlas_coords), dtype=self._image.dtype)
+            labels[inside] = self._image[
+                atlas_coords[inside, 0],
+                atlas_coords[inside, 1],
+                atlas_coords[inside, 2],
+            ]
+
+            self._resampled[key] = labels.reshape(shape)
+
+        return self._resampled[key]
+
+    def region_overlap(
+        self, maps: np.ndarray, affine: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Summarise the non-zero voxels of images per atlas region.
+
+        Parameters
+        ----------
+        maps : numpy.ndarray, shape (n, i, j, k)
+            Stack of n (e.g. thresholded) statistical maps sharing `affine`.
+
+        affine : numpy.ndarray, shape (4, 4)
+            Voxel to MNI affine of the maps.
+
+        Returns
+        -------
+        counts : numpy.ndarray, shape (n, n_regions)
+            Number of non-zero voxels of each map in each region.
+
+        means : numpy.ndarray, shape (n, n_regions)
+            Mean value of these voxels, NaN where the count is 0.
+
+        peaks : numpy.ndarray, shape (n, n_regions)
+            Value of largest magnitude among these voxels, NaN where the count
+            is 0.
+
+        Notes
+        -----
+        Region IDs index the second axis, the column 0 gathers the voxels
+        outside of any defined region. All maps are reduced together with
+        a single `np.bincount` over (map, region) pairs.
+        """
+        maps = np.asarray(maps)
+        labels = self.resample_labels(affine, maps.shape[1:])
+        n_regions = max(int(labels.max()), max(self._region_names)) + 1
+
+        map_index, *voxel = np.nonzero(maps)
+        values = maps[(map_index, *voxel)].astype(np.float64)
+        bins = map_index * n_regions + labels[tuple(voxel)]
+        size = len(maps) * n_regions
+
+        counts = np.bincount(bins, minlength=size)
+        sums = np.bincount(bins, weights=values, minlength=size)
+
+        maxima = np.full(size, -np.inf)
+        minima = np.full(size, np.inf)
+        np.maximum.at(maxima, bins, values)
+        np.minimum.at(minima, bins, values)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = sums / counts
+        peaks = np.where(maxima >= -minima, maxima, minima)
+        peaks[counts == 0] = np.nan
+
+        return (
+            counts.reshape(len(maps), n_regions),
+            means.reshape(len(maps), n_regions),
+            peaks.reshape(len(maps), n_regions),
+        )
+
     def _sort_coordinates(self, coordinates: np.ndarray) -> tuple[np.ndarray, int]:
         """Check that coordinates are in the correct format.
 
@@ -599,3 +843,32 @@ class AtlasBrowser:  # noqa: D414
         """
         for axis in axes:
             axis.axis("off")
+
+
+_atlases = {}
+
+
+def get_atlas(atlas: str, atlases_path: str = None) -> AtlasBrowser:
+    """Get the atlas browser shared by the whole process.
+
+    Parameters
+    ----------
+    atlas : str
+        The name of the atlas, see `AtlasBrowser`.
+
+    atlases_path : str (default None)
+        Folder containing the atlases, `_ATLASES_PATH` when not given.
+
+    Returns
+    -------
+    atlas : AtlasBrowser
+        The browser for `atlas`, loaded on the first call for this atlas and
+        folder, and reused on every later call.
+    """
+    atlases_path = atlases_path or _ATLASES_PATH
+    key = (os.path.abspath(atlases_path), atlas)
+
+    if key not in _atlases:
+        _atlases[key] = AtlasBrowser(atlas, atlases_path)
+
+    return _atlases[key]
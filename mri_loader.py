@@ -1,15 +1,19 @@
 import os
+import hashlib
+from dataclasses import dataclass
 
 import pandas as pd
 import numpy as np
 
-from stats import *
+import run_cache
+import confound_store
+import label_store
+import behaviour
 
 import nibabel
 from nilearn import image
 from glob import glob
 
-from nilearn.image import concat_imgs
 
 confound_columns = \
     ['a_comp_cor_00', 'a_comp_cor_01', 'a_comp_cor_02', 'a_comp_cor_03',
@@ -31,6 +35,9 @@ class Subject:
 
         self.subject_id = subject_id
         self.run_ids = run_ids
+        if folder is None:
+            folder = "."
+
         self.folder = folder
         self._dataset = [MRI(subject_id, run_id,
                              use_cache=use_cache,
@@ -44,18 +51,9 @@ class Subject:
     def compute_inflexions(self, low_percentile=25, high_percentile=75):
         all_labels = pd.concat([ds.labels for ds in self._dataset], ignore_index=True)
 
-        cur_mean, cur_std = compute_morph_scores(all_labels)
-
-        _, fitted_curve = fit_sigmoid(cur_mean)
-        curve = np.array(cur_mean["response"])
-
-        low_quartile = np.percentile(fitted_curve, low_percentile)
-        low_inflexion = find_inflexion(curve, low_quartile)
+        summary = behaviour.summarize(all_labels, low_percentile, high_percentile)
 
-        high_quartile = np.percentile(fitted_curve, high_percentile)
-        high_inflexion = find_inflexion(curve, high_quartile)
-
-        return low_inflexion, high_inflexion
+        return summary["low_inflexion"], summary["high_inflexion"]
 
     @property
     def sample_mask(self):
@@ -95,16 +93,32 @@ class Subject:
         return np.concatenate(durations)
 
     def get_excluded_couples(self):
-        with open(f"{self.folder}/labels/exclusion/couples_{self.subject_id}.csv") as f:
-            couples_data = f.readlines()
-        return [int(float(line.strip())) for line in couples_data if line.strip()]
+        return sorted(label_store.excluded_couples(self.folder, self.subject_id))
+
+    def get_masked_data(self, mask_img=None):
+        """All runs as one (n_timepoints, n_voxels) matrix, masked with the first run brain mask."""
+        if mask_img is None:
+            mask_img = self.brain_mask
+
+        return MaskedSeries.concatenate([run.get_masked_data(mask_img) for run in self._dataset])
+
+    @property
+    def run_sample_masks(self):
+        return [ds.sample_mask for ds in self._dataset]
 
     def get_data(self,
                  labels_col="morph level",
                  morph_response=False,
                  shift_onset_response=False,
                  exclude_couples=False,
-                 scale=1):
+                 scale=1,
+                 per_run=False):
+        """Images, onsets (s) and labels of the runs, concatenated in one series unless `per_run`.
+
+        The concatenated image is a lazy ConcatProxy, but it is materialised
+        in full when the GLM reads it; `per_run` gives one image per run, and
+        is what keeps the peak memory to one run.
+        """
         images = []
         times = []
         labels = []
@@ -112,20 +126,23 @@ class Subject:
         last_timestamp = 0
 
         for run in self._dataset:
-            images.append(run.data)
+            images.append(scaled_img(run.data, scale))
 
             run_labels = run.labels
 
             if exclude_couples:
                 run_labels = run_labels[~run_labels['couple'].isin(self.get_excluded_couples())]
 
+            if per_run:
+                last_timestamp = 0
+
             if shift_onset_response:
                 r_time = run_labels["run time"].values
                 resp_time = np.nan_to_num(run_labels["response time"].values)
 
                 times.append(r_time + resp_time + last_timestamp)
             else:
-                times.append(run_labels["run time"] + last_timestamp)
+                times.append(run_labels["run time"].values + last_timestamp)
 
             last_timestamp += (run.data.shape[3] * self.repetition_time) * 1000
 
@@ -138,16 +155,154 @@ class Subject:
                 new_labels = [f'{label}_{resp}' for label, resp in zip(original_labels, responses)]
                 labels.append(new_labels)
 
-        images = concat_imgs(images)
-        images = image.math_img(f"img * {scale}", img=images)
-
         # convert ms to seconds
+        if per_run:
+            return images, [t / 1000 for t in times], [np.asarray(l) for l in labels]
+
+        images = concat_runs(images)
         times = np.concatenate(times) / 1000
         labels = np.concatenate(labels)
 
         return images, times, labels
 
 
+@dataclass
+class MaskedSeries:
+    """Cleaned BOLD restricted to the voxels of a mask.
+
+    `data` is a (n_timepoints, n_voxels) float32 array whose columns follow
+    the C order of the voxels set in `mask`.
+    """
+
+    data: np.ndarray
+    mask: np.ndarray
+    affine: np.ndarray
+
+    @property
+    def n_timepoints(self):
+        return self.data.shape[0]
+
+    @property
+    def n_voxels(self):
+        return self.data.shape[1]
+
+    @property
+    def mask_img(self):
+        return nibabel.Nifti1Image(self.mask.astype(np.uint8), self.affine)
+
+    def unmask(self, values):
+        # (n_voxels,) -> 3D image, (n, n_voxels) -> 4D image
+        values = np.asarray(values)
+        grid = np.zeros((*self.mask.shape, *values.shape[:-1]), dtype=values.dtype)
+        grid[self.mask] = values.T
+        return nibabel.Nifti1Image(grid, self.affine)
+
+    @staticmethod
+    def concatenate(series):
+        first = series[0]
+        for other in series[1:]:
+            if other.mask.shape != first.mask.shape or not np.array_equal(other.mask, first.mask):
+                raise ValueError("Masked series must share the same mask to be concatenated")
+
+        return MaskedSeries(np.concatenate([s.data for s in series]), first.mask, first.affine)
+
+
+class ScaledProxy:
+    """Array proxy multiplying the data of a run by `scale` when it is read."""
+
+    is_proxy = True
+    slope, inter = 1.0, 0.0
+
+    def __init__(self, dataobj, scale):
+        self._dataobj = dataobj
+        self.scale = scale
+
+    @property
+    def shape(self):
+        return self._dataobj.shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return np.result_type(self._dataobj.dtype, np.float32)
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.multiply(np.asanyarray(self._dataobj), self.scale, dtype=self.dtype)
+        return data if dtype is None else data.astype(dtype, copy=False)
+
+    def __getitem__(self, slicer):
+        return np.multiply(np.asanyarray(self._dataobj[slicer]), self.scale, dtype=self.dtype)
+
+
+class ConcatProxy:
+    """Array proxy over several 4D runs, concatenated along time when it is read.
+
+    The runs stay as they are (memory-mapped cache entries, scaled proxies)
+    until the data is requested, and are then copied once, run by run, in a
+    single preallocated array. Fitting the concatenated image still reads it
+    whole (nilearn calls __array__), so the peak memory is one copy of every
+    run; only the per-run images of Subject.get_data(per_run=True) bound it
+    to one run.
+    """
+
+    is_proxy = True
+    slope, inter = 1.0, 0.0
+
+    def __init__(self, dataobjs):
+        self._dataobjs = dataobjs
+
+    @property
+    def shape(self):
+        return (*self._dataobjs[0].shape[:3], sum(d.shape[3] for d in self._dataobjs))
+
+    @property
+    def ndim(self):
+        return 4
+
+    @property
+    def dtype(self):
+        return np.result_type(*[d.dtype for d in self._dataobjs])
+
+    def __array__(self, dtype=None, copy=None):
+        data = np.empty(self.shape, dtype=self.dtype if dtype is None else dtype)
+
+        offset = 0
+        for dataobj in self._dataobjs:
+            n_volumes = dataobj.shape[3]
+            data[..., offset:offset + n_volumes] = np.asanyarray(dataobj)
+            offset += n_volumes
+
+        return data
+
+    def __getitem__(self, slicer):
+        return np.asarray(self)[slicer]
+
+
+def scaled_img(img, scale=1):
+    if scale == 1:
+        return img
+
+    header = img.header.copy()
+    header.set_data_dtype(np.float32)
+    return nibabel.Nifti1Image(ScaledProxy(img.dataobj, scale), img.affine, header)
+
+
+def concat_runs(imgs):
+    if len(imgs) == 1:
+        return imgs[0]
+
+    for img in imgs[1:]:
+        if img.shape[:3] != imgs[0].shape[:3] or not np.allclose(img.affine, imgs[0].affine):
+            raise ValueError("Runs must share the same grid to be concatenated")
+
+    header = imgs[0].header.copy()
+    header.set_data_dtype(np.float32)
+    return nibabel.Nifti1Image(ConcatProxy([img.dataobj for img in imgs]), imgs[0].affine, header)
+
+
 class MRI:
 
     def __init__(self, subject_id, run_id,
@@ -183,6 +338,7 @@ class MRI:
         self._mri_labels = None
         self._bg_mask = None
         self._cleaned = None
+        self._confounds = None
         self._t_r = None
 
         self._standardize = "zscore_sample"
@@ -202,10 +358,7 @@ class MRI:
     @property
     def labels(self):
         if self._raw_labels is None:
-            labels = pd.read_csv(f"{self.folder}/labels/labels_{self.subject_id}.csv")
-            labels = labels[labels["run"] == self.run_id]
-
-            self._raw_labels = labels
+            self._raw_labels = label_store.run_labels(self.folder, self.subject_id, self.run_id)
 
         return self._raw_labels
 
@@ -227,7 +380,13 @@ class MRI:
 
     @property
     def confounds(self):
-        return pd.read_csv(self._get_file('desc-confounds_timeseries.tsv'), delimiter='\t').iloc[self.volumes_offset:].reset_index(drop=True)
+        if self._confounds is None:
+            cf_df = confound_store.load(self._get_file('desc-confounds_timeseries.tsv'),
+                                        set(confound_columns) | set(reduced_columns),
+                                        f"{self.folder}/cache/confounds")
+            self._confounds = cf_df.iloc[self.volumes_offset:].reset_index(drop=True)
+
+        return self._confounds
 
     @property
     def sample_mask(self):
@@ -266,20 +425,11 @@ class MRI:
 
     @property
     def data(self):
-        if self._cleaned is None and os.path.exists(self.cache_path) and self._use_cache:
-            self._cleaned = nibabel.load(self.cache_path)
-            self._t_r = self._cleaned.header.get_zooms()[3]
-
-            data = self._cleaned.get_fdata()
-            data_trimmed = data[:, :, :, self.volumes_offset:]
-            new_img = nibabel.Nifti1Image(data_trimmed, self._cleaned.affine, self._cleaned.header)
-            self._cleaned = new_img
+        if self._cleaned is None and self._use_cache:
+            self._cleaned = self._load_cache()
 
         if self._cleaned is None:
-            taken = set(self.confounds_columns)
-            present = set(self.confounds.columns)
-            index = list(taken & present)
-            missing = list(taken - present)
+            index, missing = self._confounds_index()
             if missing:
                 print(f"Confound columns are missing: {', '.join(missing)}")
 
@@ -296,12 +446,105 @@ class MRI:
 
         return self._cleaned
 
+    def _confounds_index(self):
+        taken = set(self.confounds_columns)
+        present = set(self.confounds.columns)
+        return sorted(taken & present), sorted(taken - present)
+
+    @property
+    def cleaning_params(self):
+        source = self._get_file('preproc_bold.nii.gz')
+        self._t_r = float(nibabel.load(source).header.get_zooms()[3])
+
+        index, _ = self._confounds_index()
+
+        return {
+            "confounds_mode": self.confounds_mode,
+            "confounds": index,
+            "standardize": self._standardize,
+            "detrend": self._detrend,
+            "low_pass": self._low_pass,
+            "high_pass": self._high_pass,
+            "t_r": self._t_r,
+            "source": run_cache.source_stat(source),
+            "confounds_source": run_cache.source_stat(self._get_file('desc-confounds_timeseries.tsv')),
+        }
+
+    def _load_cache(self):
+        # uncompressed float32 entries are memory-mapped, the offset is a view
+        # on the mapped array
+        params = self.cleaning_params
+        path = self._entry_path(params)
+        if not run_cache.is_valid(path, params):
+            return None
+
+        cached = nibabel.load(path, mmap="c")
+        self._t_r = cached.header.get_zooms()[3]
+
+        data = np.asanyarray(cached.dataobj)[:, :, :, self.volumes_offset:]
+        return nibabel.Nifti1Image(data, cached.affine, cached.header)
+
+    def _entry_path(self, params):
+        key = run_cache.cache_key(params)
+        return run_cache.entry_path(self.folder, self.confounds_mode, self.subject_id, self.run_id, key)
+
     @property
     def cache_path(self):
-        return f"{self.folder}/cache/{self.confounds_mode}_confounds/sub-{self.subject_id}-run-{self.run_id}.nii.gz"
+        return self._entry_path(self.cleaning_params)
 
     def cache(self, override_cache=False):
-        os.makedirs(f"{self.folder}/cache", exist_ok=True)
-        if not os.path.exists(self.cache_path) or override_cache:
-            nibabel.save(self.data, self.cache_path)
+        params = self.cleaning_params
+        path = self._entry_path(params)
+
+        if run_cache.is_valid(path, params) and not override_cache:
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        cleaned = self.data
+        header = cleaned.header.copy()
+        header.set_data_dtype(np.float32)
+        img = nibabel.Nifti1Image(np.asarray(cleaned.dataobj, dtype=np.float32), cleaned.affine, header)
+
+        # write next to the target then rename, so readers never map a partial file
+        tmp_path = f"{path[:-len('.nii')]}.{os.getpid()}.tmp.nii"
+        nibabel.save(img, tmp_path)
+        os.replace(tmp_path, path)
+        run_cache.write_sidecar(path, params, self.subject_id, self.run_id)
+
+        run_cache.prune_stale(path, params)
+
+    def get_masked_data(self, mask_img=None):
+        """Cleaned run as a (n_timepoints, n_voxels) float32 matrix, cached next to the cleaned run."""
+        if mask_img is None:
+            mask_img = self.brain_mask
+
+        mask = np.asanyarray(mask_img.dataobj) > 0
+        mask_key = hashlib.sha1(np.packbits(mask).tobytes() + np.asarray(mask_img.affine).tobytes()).hexdigest()[:16]
+
+        params = {**self.cleaning_params, "mask": {"shape": list(mask.shape), "key": mask_key}}
+        path = run_cache.entry_path(self.folder, self.confounds_mode, self.subject_id, self.run_id,
+                                    run_cache.cache_key(params), extension=".npy")
+
+        if self._use_cache and run_cache.is_valid(path, params):
+            data = np.load(path, mmap_mode="r")
+        else:
+            data = np.ascontiguousarray(np.asanyarray(self._full_cleaned().dataobj)[mask].T, dtype=np.float32)
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path[:-len('.npy')]}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, data)
+            os.replace(tmp_path, path)
+            run_cache.write_sidecar(path, params, self.subject_id, self.run_id)
+
+        return MaskedSeries(data[self.volumes_offset:], mask, mask_img.affine)
+
+    def _full_cleaned(self):
+        # the masked matrix keeps every volume, volumes_offset is applied on read
+        params = self.cleaning_params
+        path = self._entry_path(params)
+
+        if self._use_cache and run_cache.is_valid(path, params):
+            return nibabel.load(path, mmap="c")
 
+        return self.data
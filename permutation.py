@@ -0,0 +1,279 @@
+"""Sign-flip permutation tests for one-sample group analyses.
+
+Everything works on the (n_subjects, n_voxels) matrix of the subject maps.
+Flipping the sign of a subject leaves its sum of squares unchanged, so the
+t-maps of a whole chunk of permutations only need the permuted means, that
+is one product of the (chunk, n_subjects) sign-flip matrix with the data.
+
+The spatial statistics work on the face adjacency graph of the mask, built
+once: the clusters of a t-map are the connected components of that graph
+restricted to its supra-threshold voxels.
+"""
+import numpy as np
+from scipy import sparse
+from scipy import stats as sps
+from scipy.sparse.csgraph import connected_components
+
+
+# permutations per matrix product, small enough for a chunk of t-maps to stay in cache
+CHUNK_SIZE = 32
+
+
+def sign_flips(n_subjects, n_permutations, seed=0):
+    """(n_permutations, n_subjects) matrix of +-1, the first row leaving the data unchanged.
+
+    When there are no more than `n_permutations` distinct flips, all of them
+    are enumerated once and the test is exact.
+    """
+    if 2 ** n_subjects <= n_permutations:
+        bits = (np.arange(2 ** n_subjects)[:, np.newaxis] >> np.arange(n_subjects)) & 1
+        return 1.0 - 2.0 * bits
+
+    rng = np.random.default_rng(seed)
+    signs = rng.choice([-1.0, 1.0], size=(n_permutations, n_subjects))
+    signs[0] = 1.0
+    return signs
+
+
+def permuted_t(Y, signs, sum_squares=None):
+    """(n_flips, n_voxels) one-sample t-maps of `Y` with each row of `signs` applied to its subjects."""
+    n_subjects = Y.shape[0]
+    if sum_squares is None:
+        sum_squares = np.einsum("sv,sv->v", Y, Y)
+
+    # t = mean / sqrt(variance / n), variance = (sum_squares - n * mean^2) / (n - 1), in place on the sums
+    t = signs @ Y
+    scale = t * t
+    scale *= -1 / n_subjects
+    scale += sum_squares
+    # smallest normal of the dtype, 1e-50 would be 0 in float32
+    np.maximum(scale, np.finfo(scale.dtype).tiny, out=scale)
+    np.sqrt(scale, out=scale)
+
+    t /= scale
+    t *= np.sqrt((n_subjects - 1) / n_subjects)
+    return t
+
+
+def one_sample_t(Y, dtype=np.float64):
+    """t-map of the intercept-only second-level model, as SecondLevelModel's "stat" output."""
+    Y = np.asarray(Y, dtype=dtype)
+    return permuted_t(Y, np.ones((1, Y.shape[0]), dtype=dtype))[0]
+
+
+def max_null(Y, n_permutations=10000, two_sided=False, statistic=None,
+             chunk_size=CHUNK_SIZE, seed=0, dtype=np.float32):
+    """Null distribution of the maximum statistic over voxels, one value per sign flip.
+
+    `statistic` maps a (chunk, n_voxels) stack of t-maps to the statistic
+    maps (`cluster_mass`, `tfce`), the t-maps themselves when None. The
+    t-maps are computed in `dtype`, float32 halving the memory traffic that
+    bounds the permutations.
+    """
+    Y = np.asarray(Y, dtype=dtype)
+    signs = sign_flips(Y.shape[0], n_permutations, seed).astype(dtype)
+    sum_squares = np.einsum("sv,sv->v", Y, Y)
+
+    null = np.empty(len(signs))
+    for start in range(0, len(signs), chunk_size):
+        stat = permuted_t(Y, signs[start:start + chunk_size], sum_squares)
+        if statistic is not None:
+            stat = statistic(stat)
+
+        null[start:start + chunk_size] = (np.abs(stat) if two_sided else stat).max(axis=1)
+
+    return null
+
+
+def null_p_values(stat, null):
+    """Fraction of `null` reaching each value of `stat`, from one sort and a binary search per value."""
+    sorted_null = np.sort(null)
+    return (len(sorted_null) - np.searchsorted(sorted_null, stat, side="left")) / len(sorted_null)
+
+
+def fwe_p_values(observed, null, two_sided=False):
+    """FWE-corrected p-value of every voxel, the fraction of the max null reaching its statistic."""
+    return null_p_values(np.abs(observed) if two_sided else observed, null)
+
+
+def adjacency(mask):
+    """(2, n_edges) face-neighbour pairs of the voxels of the 3D boolean `mask`, as indices of `data[mask]`.
+
+    Face connectivity, as nilearn's permuted_ols cluster inference. Each
+    pair is listed once, from its lower index, and the pairs are sorted by
+    source so the edges of a subgraph directly give its CSR matrix.
+    """
+    index = np.full(mask.shape, -1, dtype=np.int32)
+    index[mask] = np.arange(mask.sum())
+
+    edges = []
+    for axis in range(3):
+        lower = [slice(None)] * 3
+        upper = [slice(None)] * 3
+        lower[axis] = slice(None, -1)
+        upper[axis] = slice(1, None)
+
+        a, b = index[tuple(lower)], index[tuple(upper)]
+        pair = (a >= 0) & (b >= 0)
+        edges.append((a[pair], b[pair]))
+
+    source, target = (np.concatenate(e) for e in zip(*edges))
+    order = np.lexsort((target, source))
+    return np.stack([source[order], target[order]])
+
+
+def restrict(keep, edges):
+    """Edges between the nodes of the boolean `keep`, renumbered as indices of `nodes[keep]`."""
+    index = np.cumsum(keep, dtype=np.int32) - 1
+    source, target = edges
+
+    kept = keep[source] & keep[target]
+    return np.stack([index[source[kept]], index[target[kept]]])
+
+
+def components(n_nodes, edges):
+    """Connected component of every node of the undirected graph."""
+    source, target = edges
+
+    indptr = np.zeros(n_nodes + 1, dtype=np.int32)
+    np.cumsum(np.bincount(source, minlength=n_nodes), out=indptr[1:])
+
+    graph = sparse.csr_matrix((np.ones(len(target), dtype=np.int8), target, indptr), shape=(n_nodes, n_nodes))
+    graph.has_sorted_indices = True
+
+    return connected_components(graph, directed=False)[1]
+
+
+def cluster_mass_map(t, edges, height, two_sided=False):
+    """Mass (sum of t above `height`) of the cluster of every voxel, 0 outside clusters."""
+    masses = np.zeros(len(t))
+
+    for sign in ((1, -1) if two_sided else (1,)):
+        excess = sign * t - height
+        in_cluster = excess > 0
+        if not in_cluster.any():
+            continue
+
+        labels = components(in_cluster.sum(), restrict(in_cluster, edges))
+        masses[in_cluster] = sign * np.bincount(labels, weights=excess[in_cluster])[labels]
+
+    return masses
+
+
+def tfce_map(t, edges, dh=0.1, E=0.5, H=2.0, two_sided=False):
+    """Threshold-free cluster enhancement of every voxel, sum over heights h of extent(h)^E * h^H * dh."""
+    enhanced = np.zeros(len(t))
+
+    for sign in ((1, -1) if two_sided else (1,)):
+        # the supra-threshold voxels only shrink with h, each level relabels what is left of the previous one
+        voxels = np.arange(len(t))
+        values = sign * t
+        level_edges = edges
+
+        for h in np.arange(dh, values.max() + dh, dh):
+            above = values >= h
+            if not above.any():
+                break
+
+            level_edges = restrict(above, level_edges)
+            voxels, values = voxels[above], values[above]
+
+            labels = components(len(voxels), level_edges)
+            enhanced[voxels] += sign * np.bincount(labels)[labels] ** E * h ** H * dh
+
+    return enhanced
+
+
+def statistic_map(t, edges, statistic, height=None, two_sided=False):
+    """`statistic` ("t", "cluster_mass" or "tfce") of one t-map over the voxel graph `edges`."""
+    if statistic == "t":
+        return t
+    if statistic == "cluster_mass":
+        return cluster_mass_map(t, edges, height, two_sided)
+    if statistic == "tfce":
+        return tfce_map(t, edges, two_sided=two_sided)
+
+    raise ValueError(f"Unknown statistic {statistic=}, expected 't', 'cluster_mass' or 'tfce'")
+
+
+def cluster_mass(mask, height, two_sided=False):
+    """Statistic for `max_null`: cluster mass of every voxel of the `mask` t-maps."""
+    edges = adjacency(mask)
+
+    def statistic(t):
+        return np.stack([cluster_mass_map(v, edges, height, two_sided) for v in t])
+    return statistic
+
+
+def tfce(mask, two_sided=False, dh=0.1, E=0.5, H=2.0):
+    """Statistic for `max_null`: TFCE of every voxel of the `mask` t-maps."""
+    edges = adjacency(mask)
+
+    def statistic(t):
+        return np.stack([tfce_map(v, edges, dh, E, H, two_sided) for v in t])
+    return statistic
+
+
+def make_statistic(name, n_subjects, mask=None, height=None, two_sided=False):
+    if name == "t":
+        return None
+
+    if mask is None:
+        raise ValueError(f"The {name!r} statistic needs the brain mask of the voxels")
+
+    # a mask image (masker.mask_img_) or a 3D array
+    if hasattr(mask, "dataobj"):
+        mask = np.asanyarray(mask.dataobj) > 0
+    mask = np.asarray(mask, dtype=bool)
+
+    if name == "cluster_mass":
+        # cluster forming threshold, p < 0.001 uncorrected by default
+        if height is None:
+            height = sps.t.isf(0.001, n_subjects - 1)
+        return cluster_mass(mask, height, two_sided)
+
+    if name == "tfce":
+        return tfce(mask, two_sided)
+
+    raise ValueError(f"Unknown statistic {name=}, expected 't', 'cluster_mass' or 'tfce'")
+
+
+def permutation_test(Y, n_permutations=10000, two_sided=False, statistic="t", mask=None, height=None,
+                     chunk_size=CHUNK_SIZE, seed=0, dtype=np.float32):
+    """Observed statistic map, max null distribution and FWE p-values of a one-sample sign-flip test.
+
+    `Y` is the (n_subjects, n_voxels) matrix of the subject maps, e.g.
+    `masker.fit_transform(subject_imgs)`, and `statistic` one of "t",
+    "cluster_mass" or "tfce". The spatial statistics need the 3D mask the
+    voxels come from, as an image (`masker.mask_img_`) or a boolean array;
+    cluster mass voxels get the p-value of their cluster. The observed map
+    is computed in the same `dtype` as the null, whose first permutation it
+    is.
+    """
+    Y = np.asarray(Y)
+    statistic = make_statistic(statistic, Y.shape[0], mask, height, two_sided)
+
+    observed = one_sample_t(Y, dtype)
+    if statistic is not None:
+        observed = statistic(observed[np.newaxis])[0]
+
+    null = max_null(Y, n_permutations, two_sided, statistic, chunk_size, seed, dtype)
+    # the first flip is the identity, pinned to the observed maximum against rounding differences of the products
+    null[0] = (np.abs(observed) if two_sided else observed).max()
+
+    return observed, null, fwe_p_values(observed, null, two_sided)
+
+
+def fwe_maps(stack, n_permutations=10000, two_sided=False, statistic="t", mask=None, height=None,
+             chunk_size=CHUNK_SIZE, seed=0, dtype=np.float32):
+    """`permutation_test` of every contrast of a (n_contrasts, n_subjects, n_voxels) stack.
+
+    Returns the (n_contrasts, n_voxels) observed maps, the
+    (n_contrasts, n_permutations) null distributions and the
+    (n_contrasts, n_voxels) FWE p-values.
+    """
+    results = [permutation_test(Y, n_permutations, two_sided, statistic, mask, height, chunk_size, seed, dtype)
+               for Y in stack]
+
+    observed, null, p_values = zip(*results)
+    return np.stack(observed), np.stack(null), np.stack(p_values)
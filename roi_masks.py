@@ -0,0 +1,108 @@
+"""Atlas ROI masks in the functional space of the cohort.
+
+The target grid is read from the header of a preprocessed run, the ROI
+voxels are found in one pass over the atlas labels, and the resulting mask
+images are cached on disk (keyed on atlas, ROI set and grid) with their
+fitted maskers kept for the process.
+"""
+import os
+
+import numpy as np
+import nibabel
+from nibabel.affines import apply_affine
+from nilearn.maskers import NiftiMasker
+
+import run_cache
+from mri_loader import MRI
+from lib.mni_to_atlas import get_atlas
+
+
+MOTOR_ROI = ['Precentral_L', 'Precentral_R', 'Supp_Motor_Area_L', 'Supp_Motor_Area_R']
+
+# mask path -> fitted NiftiMasker
+_maskers = {}
+
+
+def functional_grid(folder=".", subject_id=1, run_id=1):
+    # nibabel only parses the header here, the volumes are never read
+    header = nibabel.load(MRI(subject_id, run_id, folder=folder)._get_file('preproc_bold.nii.gz'))
+    return header.affine, header.shape[:3]
+
+
+def mask_folder(folder, atlas, rois, affine, shape):
+    key = run_cache.cache_key({
+        "atlas": atlas.atlas_name,
+        "atlas_source": run_cache.source_stat(atlas._path + ".nii"),
+        "rois": list(rois),
+        "affine": np.asarray(affine).tolist(),
+        "shape": list(shape),
+    })
+    return f"{folder}/cache/masks/{atlas.atlas_name}-{key}"
+
+
+def roi_voxels(atlas, rois, affine, shape):
+    """Functional voxels of every ROI, the atlas labels being scanned once for all of them."""
+    lookup_regions = {v: k for k, v in atlas._region_names.items()}
+    missing = [region for region in rois if region not in lookup_regions]
+    if missing:
+        raise ValueError(f"Unknown regions {missing} in atlas {atlas.atlas_name}")
+
+    indexes = [lookup_regions[region] for region in rois]
+
+    atlas_mask = np.argwhere(np.isin(atlas._image, indexes))
+    labels = atlas._image[atlas_mask[:, 0], atlas_mask[:, 1], atlas_mask[:, 2]]
+
+    mni_mask = atlas._convert_atlas_to_mni_space(atlas_mask)
+    image_mask = np.round(apply_affine(np.linalg.inv(affine), mni_mask)).astype(np.int32)
+
+    # atlas voxels falling outside of the functional field of view are dropped
+    inside = np.all((image_mask >= 0) & (image_mask < shape), axis=1)
+
+    return {region: np.unique(image_mask[inside & (labels == index)], axis=0) for region, index in zip(rois, indexes)}
+
+
+def _save(img, path):
+    tmp_path = f"{path[:-len('.nii.gz')]}.{os.getpid()}.tmp.nii.gz"
+    nibabel.save(img, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def roi_masks(rois=None, folder="."):
+    """Binary mask image of every ROI plus their union under "merged", cached on disk."""
+    rois = list(rois or MOTOR_ROI)
+    atlas = get_atlas("AAL3", f"{folder}/lib")
+    affine, shape = functional_grid(folder)
+
+    target = mask_folder(folder, atlas, rois, affine, shape)
+    paths = {region: f"{target}/{region}.nii.gz" for region in rois + ["merged"]}
+
+    if not all(os.path.exists(path) for path in paths.values()):
+        os.makedirs(target, exist_ok=True)
+        voxels = roi_voxels(atlas, rois, affine, shape)
+        voxels["merged"] = np.concatenate(list(voxels.values()), axis=0)
+
+        for region, coords in voxels.items():
+            applied_mask = np.zeros(shape, dtype=np.uint8)
+            applied_mask[coords[:, 0], coords[:, 1], coords[:, 2]] = 1
+            _save(nibabel.Nifti1Image(applied_mask, affine=affine), paths[region])
+
+    return paths
+
+
+def masker(path):
+    if path not in _maskers:
+        _maskers[path] = NiftiMasker(mask_img=nibabel.load(path)).fit()
+    return _maskers[path]
+
+
+def motor_mask(merged=True, override_roi=None, folder="."):
+    """Fitted masker(s) and mask image(s) of the motor ROI, as stats.generate_motor_mask."""
+    paths = roi_masks(override_roi, folder)
+
+    if merged:
+        fitted = masker(paths["merged"])
+        return fitted, fitted.mask_img_
+
+    regions = [region for region in paths if region != "merged"]
+    masks = {region: masker(paths[region]) for region in regions}
+    return masks, {region: masks[region].mask_img_ for region in regions}
@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+from glob import glob
+
+import pandas as pd
+
+
+def source_stat(path):
+    stat = os.stat(path)
+    return {"file": os.path.basename(path), "size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def cache_key(params):
+    # every input of image.clean_img goes in the key, so variants coexist on disk
+    encoded = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+def entry_path(folder, confounds_mode, subject_id, run_id, key, extension=".nii"):
+    return f"{folder}/cache/{confounds_mode}_confounds/sub-{subject_id}-run-{run_id}-{key}{extension}"
+
+
+def sidecar_path(path):
+    return f"{os.path.splitext(path)[0]}.json"
+
+
+def write_sidecar(path, params, subject_id, run_id):
+    entry = {"subject": subject_id, "run": run_id, "key": cache_key(params), "file": os.path.basename(path),
+             "params": params}
+
+    tmp_path = f"{sidecar_path(path)}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(entry, f, indent=2, sort_keys=True, default=str)
+    os.replace(tmp_path, sidecar_path(path))
+
+
+def read_sidecar(path):
+    with open(sidecar_path(path)) as f:
+        return json.load(f)
+
+
+def entry_file(sidecar, entry):
+    # sidecars written before masked entries existed only described .nii files
+    return entry.get("file", f"{os.path.splitext(os.path.basename(sidecar))[0]}.nii")
+
+
+def is_valid(path, params):
+    if not os.path.exists(path) or not os.path.exists(sidecar_path(path)):
+        return False
+
+    try:
+        return read_sidecar(path)["key"] == cache_key(params)
+    except (OSError, ValueError, KeyError):
+        return False
+
+
+def manifest(folder="."):
+    """One row per cached cleaned run, with its cleaning parameters."""
+    rows = []
+
+    for path in glob(f"{folder}/cache/*_confounds/sub-*-run-*-*.json"):
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+        params = entry["params"]
+        file = entry_file(path, entry)
+        rows.append({
+            "path": f"{os.path.dirname(path)}/{file}",
+            "format": os.path.splitext(file)[1],
+            "subject": entry["subject"],
+            "run": entry["run"],
+            "key": entry["key"],
+            "confounds_mode": params["confounds_mode"],
+            "standardize": params["standardize"],
+            "detrend": params["detrend"],
+            "low_pass": params["low_pass"],
+            "high_pass": params["high_pass"],
+            "t_r": params["t_r"],
+            "source": params["source"],
+            "confounds_source": params["confounds_source"],
+        })
+
+    return pd.DataFrame(rows)
+
+
+def is_stale(params, current_sources):
+    # an entry whose inputs changed on disk can never be hit again
+    return params["source"] != current_sources[0] or params["confounds_source"] != current_sources[1]
+
+
+def prune_stale(path, params):
+    """Remove the entries of the same run whose source files changed since they were cleaned."""
+    removed = []
+    prefix = path[:path.rindex('-')]
+
+    for other in glob(f"{prefix}-*.json"):
+        try:
+            with open(other) as f:
+                entry = json.load(f)
+            other_path = f"{os.path.dirname(other)}/{entry_file(other, entry)}"
+            other_params = entry["params"]
+        except (OSError, ValueError, KeyError):
+            continue
+
+        if other_path == path:
+            continue
+
+        if is_stale(other_params, (params["source"], params["confounds_source"])):
+            for f in (other_path, other):
+                if os.path.exists(f):
+                    os.remove(f)
+            removed.append(other_path)
+
+    return removed
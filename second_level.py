@@ -0,0 +1,141 @@
+"""Group-level permutation inference on the z-maps saved by gen_contrasts.
+
+The face adjacency graph of the group mask is built once, and every
+permuted t-map goes through permutation.statistic_map on it. Permutations
+are split in chunks run in parallel, each chunk drawing its sign flips from
+its own seed, so the null distribution does not depend on the number of
+workers.
+"""
+import os
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import nibabel
+from scipy import stats as sps
+from nilearn.masking import unmask
+
+import gen_contrasts as gc
+import permutation
+import contrast_store
+
+
+# set in every worker by _init_worker, the data is only sent once per process
+_shared = {}
+
+
+def chunk_flips(n_subjects, n_permutations, chunk_index, chunk_size, seed):
+    """Sign flips of one chunk of permutations, drawn from the (seed, chunk_index) stream."""
+    if 2 ** n_subjects <= n_permutations:
+        return permutation.sign_flips(n_subjects, n_permutations)[chunk_index * chunk_size:(chunk_index + 1) * chunk_size]
+
+    rng = np.random.default_rng([seed, chunk_index])
+    signs = rng.choice([-1.0, 1.0], size=(min(chunk_size, n_permutations - chunk_index * chunk_size), n_subjects))
+    if chunk_index == 0:
+        signs[0] = 1.0
+    return signs
+
+
+def _init_worker(Y, edges, statistic, height, two_sided):
+    _shared.update(Y=Y, edges=edges, statistic=statistic, height=height, two_sided=two_sided,
+                   sum_squares=np.einsum("sv,sv->v", Y, Y))
+
+
+def _max_chunk(chunk_index, n_permutations, chunk_size, seed):
+    Y, edges = _shared["Y"], _shared["edges"]
+    signs = chunk_flips(Y.shape[0], n_permutations, chunk_index, chunk_size, seed).astype(Y.dtype)
+
+    maxima = []
+    for t in permutation.permuted_t(Y, signs, _shared["sum_squares"]):
+        stat = permutation.statistic_map(t, edges, _shared["statistic"], _shared["height"], _shared["two_sided"])
+        maxima.append((np.abs(stat) if _shared["two_sided"] else stat).max())
+
+    return maxima
+
+
+def group_test(Y, mask, statistic="tfce", n_permutations=10000, two_sided=False, height=None,
+               chunk_size=100, seed=0, workers=None, dtype=np.float32):
+    """Observed statistic map, max null distribution and FWE p-values of a one-sample sign-flip test.
+
+    `Y` is the (n_subjects, n_voxels) matrix of the `mask` voxels. The
+    cluster forming `height` of the cluster mass defaults to the t at
+    p < 0.001 uncorrected.
+    """
+    Y = np.asarray(Y, dtype=dtype)
+    edges = permutation.adjacency(mask)
+
+    if height is None:
+        height = sps.t.isf(0.001, Y.shape[0] - 1)
+
+    # every flip is enumerated when there are fewer than requested
+    n_permutations = min(n_permutations, 2 ** Y.shape[0])
+    chunks = range(-(-n_permutations // chunk_size))
+
+    args = (Y, edges, statistic, height, two_sided)
+    max_chunk = partial(_max_chunk, n_permutations=n_permutations, chunk_size=chunk_size, seed=seed)
+
+    if workers == 1:
+        _init_worker(*args)
+        maxima = [max_chunk(chunk) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=args) as pool:
+            maxima = list(pool.map(max_chunk, chunks))
+
+    null = np.concatenate(maxima)
+
+    observed = permutation.statistic_map(permutation.one_sample_t(Y, dtype), edges, statistic, height, two_sided)
+    # the first flip is the identity, pinned to the observed maximum against rounding differences of the products
+    null[0] = (np.abs(observed) if two_sided else observed).max()
+
+    return observed, null, permutation.fwe_p_values(observed, null, two_sided)
+
+
+def group_path(cfg, statistic, c_name, extension=".nii.gz"):
+    fname = c_name.replace(' ', '_').replace('>', 'over')
+
+    return f"brute_force/{gc.path(cfg)}/group/{statistic}-{fname}{extension}"
+
+
+def run(cfg, statistic="tfce", n_permutations=10000, two_sided=False, smoothing_fwhm=None, workers=None, seed=0):
+    contrasts = [gc.contrast_name(c) for c in gc.gen_contrast_list(cfg.PREDICTORS)]
+
+    # subjects without the map of a contrast their design could not express are left out
+    subject_ids = gc.get_subject_ids(cfg)
+    subjects = gc.subjects_with_maps(cfg, subject_ids, contrasts)
+    if len(subjects) < len(subject_ids):
+        print(f"Subjects {sorted(set(subject_ids) - set(subjects))} miss contrast maps, left out")
+
+    stack = contrast_store.load(cfg, subjects, contrasts, smoothing_fwhm)
+
+    # the test runs on the voxels every map covers
+    covered = np.all(stack.data != 0, axis=(0, 1))
+    mask = stack.mask.copy()
+    mask[stack.mask] = covered
+    mask_img = nibabel.Nifti1Image(mask.astype(np.uint8), stack.affine)
+
+    os.makedirs(f"brute_force/{gc.path(cfg)}/group/", exist_ok=True)
+
+    for c_name in contrasts:
+        observed, null, p_values = group_test(stack.contrast(c_name)[:, covered], mask, statistic, n_permutations,
+                                              two_sided, seed=seed, workers=workers)
+
+        # -log10(p) maps, as the permutation notebooks
+        nibabel.save(unmask(-np.log10(p_values), mask_img), group_path(cfg, statistic, c_name))
+        np.save(group_path(cfg, statistic, c_name, "_null.npy"), null)
+
+        print(f"{c_name}: {len(subjects)} subjects, min p {p_values.min():.4f}")
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Permutation inference on the subject z-maps of a configuration.")
+    parser.add_argument("--statistic", default="tfce", choices=["t", "cluster_mass", "tfce"])
+    parser.add_argument("--permutations", type=int, default=10000)
+    parser.add_argument("--two-sided", action="store_true")
+    parser.add_argument("--smoothing", type=float, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    run(gc.Config(), args.statistic, args.permutations, args.two_sided, args.smoothing, args.workers, args.seed)
@@ -1,16 +1,27 @@
 from collections import defaultdict
 
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-from scipy.interpolate import interp1d
-
 from scipy.optimize import curve_fit
-from scipy.stats import gaussian_kde
 
-from nilearn.maskers import NiftiMasker
 
-plt.style.use('seaborn-v0_8')
+__all__ = ["compute_morph_scores", "sigmoid", "fit_sigmoid", "find_inflexion", "fit_sigmoids", "find_inflexions",
+           "contrast_name", "parse_contrast",
+           "plot_behavioral_data", "plot_r2", "carpet_plot", "plot_timeseries_list", "plot_timeseries",
+           "generate_motor_mask", "generate_html"]
+
+# pre-set parameters to get right curve orientation
+SIGMOID_P0 = [-1, 0, 1, 1]
+
+# served from plots, matplotlib is only imported when one of them is first used
+_PLOTS = ["plot_behavioral_data", "plot_r2", "carpet_plot", "plot_timeseries_list", "plot_timeseries"]
+
+
+def __getattr__(name):
+    if name in _PLOTS:
+        import plots
+        return getattr(plots, name)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def compute_morph_scores(df, columns=None):
@@ -43,9 +54,7 @@ def fit_sigmoid(mean):
     ydata = np.array(mean["response"])
     # fit scale is in 0.05-0.95, csv is in scale 5-95
     xdata = np.linspace(0.05, 0.95, 10)
-    p0 = [-1, 0, 1, 1]  # pre-set parameters to get right curve orientation
-
-    popt, _ = curve_fit(sigmoid, xdata, ydata, p0, full_output=False)
+    popt, _ = curve_fit(sigmoid, xdata, ydata, SIGMOID_P0, full_output=False)
 
     return popt, sigmoid(xdata, *popt)
 
@@ -62,6 +71,103 @@ def find_inflexion(fitted_curve, threshold=0.5):
     return None
 
 
+def fit_sigmoids(ydata, p0=SIGMOID_P0, max_iter=1000, tol=1.49e-8):
+    """Least-squares sigmoids of every row of the (n_curves, 10) morph means, all fitted at once.
+
+    Levenberg-Marquardt on the stacked curves, as curve_fit does one curve
+    at a time: every iteration solves the (n_curves, 4, 4) damped normal
+    equations in one batch, each curve keeping its own damping and MINPACK
+    style scaling. Returns the (n_curves, 4) parameters, NaN for the curves
+    which did not converge, and the (n_curves, 10) fitted curves. `p0` is
+    either shared or one (n_curves, 4) starting point per curve.
+    """
+    ydata = np.asarray(ydata, dtype=np.float64)
+    xdata = np.linspace(0.05, 0.95, 10)
+    n_curves = len(ydata)
+
+    # one starting point for all the curves, or one per curve
+    params = np.array(np.broadcast_to(np.asarray(p0, dtype=np.float64), (n_curves, 4)))
+    damping = np.ones(n_curves)
+    scale = np.zeros((n_curves, 4))
+    converged = np.zeros(n_curves, dtype=bool)
+    failed = np.zeros(n_curves, dtype=bool)
+
+    def residuals(p, y):
+        with np.errstate(over="ignore"):
+            return sigmoid(xdata, *p.T[..., np.newaxis]) - y
+
+    r = residuals(params, ydata)
+    cost = np.einsum("ij,ij->i", r, r)
+
+    for _ in range(max_iter):
+        index = np.flatnonzero(~(converged | failed))
+        if not len(index):
+            break
+
+        p, y = params[index], ydata[index]
+        r = residuals(p, y)
+        L, x0, k = p[:, 0:1], p[:, 1:2], p[:, 2:3]
+
+        with np.errstate(over="ignore"):
+            s = 1 / (1 + np.exp(-k * (xdata - x0)))
+        slope = L * s * (1 - s)
+        jacobian = np.stack([s, -k * slope, (xdata - x0) * slope, np.ones_like(s)], axis=2)
+
+        jtj = np.matmul(jacobian.transpose(0, 2, 1), jacobian)
+        jtr = np.matmul(jacobian.transpose(0, 2, 1), r[..., np.newaxis])[..., 0]
+
+        # the damping is scaled by the largest curvature seen along each parameter, as MINPACK's diag
+        scale[index] = np.maximum(scale[index], np.einsum("nii->ni", jtj))
+        damped = jtj + (damping[index, np.newaxis] * np.maximum(scale[index], 1e-12))[..., np.newaxis] * np.eye(4)
+
+        # a diverging curve must not stop the batch, it is dropped from it instead
+        finite = np.isfinite(damped).all(axis=(1, 2)) & np.isfinite(jtr).all(axis=1)
+        failed[index[~finite]] = True
+        damped[~finite], jtr[~finite] = np.eye(4), 0
+
+        step = -np.linalg.solve(damped, jtr[..., np.newaxis])[..., 0]
+
+        trial = p + step
+        trial_r = residuals(trial, y)
+        trial_cost = np.einsum("ij,ij->i", trial_r, trial_r)
+
+        better = finite & np.isfinite(trial_cost) & (trial_cost <= cost[index])
+        params[index[better]] = trial[better]
+        damping[index] = np.where(better, damping[index] / 10, damping[index] * 10)
+
+        # curve_fit's ftol and xtol, on the relative decrease of the cost and size of the step
+        small_gain = cost[index] - trial_cost <= tol * cost[index]
+        small_step = np.linalg.norm(step, axis=1) <= tol * np.linalg.norm(p, axis=1)
+        converged[index] = better & (small_gain | small_step)
+        failed[index] |= damping[index] > 1e16
+
+        cost[index[better]] = trial_cost[better]
+
+    # out of iterations or stalled: no fit, as curve_fit raising
+    params[~converged] = np.nan
+
+    with np.errstate(over="ignore", invalid="ignore"):
+        return params, sigmoid(xdata, *params.T[..., np.newaxis])
+
+
+def find_inflexions(curves, thresholds):
+    """`find_inflexion` of every (curve, threshold) pair at once, NaN where a curve never crosses its threshold."""
+    curves = np.asarray(curves, dtype=np.float64)
+    xinterp = np.linspace(0.05, 0.95, 1000)
+    xvals = np.linspace(0.05, 0.95, 10)
+
+    # the linear interpolation of np.interp, for every curve from one gather
+    segment = np.clip(np.searchsorted(xvals, xinterp, side="right") - 1, 0, len(xvals) - 2)
+    slopes = np.diff(curves, axis=1) / np.diff(xvals)
+    interpolated = slopes[:, segment] * (xinterp - xvals[segment]) + curves[:, segment]
+    interpolated[:, -1] = curves[:, -1]
+
+    above = interpolated > np.asarray(thresholds, dtype=np.float64)[:, np.newaxis]
+    crossing = above[:, 1:] != above[:, :-1]
+
+    return np.where(crossing.any(axis=1), xinterp[np.argmax(crossing, axis=1)], np.nan)
+
+
 def contrast_name(classes):
     positive = 'rest'
     negative = 'rest'
@@ -115,341 +221,10 @@ def parse_contrast(contrasts, low_inflexion, high_inflexion):
         contrasts[key] = np.sum(cols, axis=0)
 
 
-def plot_behavioral_data(mean, std, sigmoid_curve=None, inflexion_point=None, title=None):
-
-    morph = mean.index
-
-    with plt.style.context('seaborn-v0_8'):
-        fig, ax = plt.subplots(ncols=2, squeeze=False, figsize=(15, 5))
-
-        if title:
-            fig.suptitle(title, fontweight="bold")
-
-        resp_mean = mean["response"]
-        resp_std = std["response"]
-
-        ax0 = ax[0, 0]
-        ax0.plot(resp_mean, label="response")
-        ax0.fill_between(morph, resp_mean - resp_std, resp_mean + resp_std, alpha=0.3)
-
-        if sigmoid_curve is not None:
-            ax0.plot(morph, sigmoid_curve, label="fitted sigmoid")
-
-        if inflexion_point is not None:
-            ax0.axvline(x=inflexion_point * 100, color="blue", linestyle="--", label=f"Inflexion threshold (>50%): {inflexion_point:.2f}")
-
-        ax0.set_xticks(morph)
-        ax0.set_xlabel("% morph (alpha)")
-        ax0.set_ylabel("response")
-        ax0.legend()
-
-        time_mean = mean["response time"]
-        time_std = std["response time"]
-
-        ax1 = ax[0, 1]
-        ax1.plot(time_mean, label="response time")
-        ax1.fill_between(morph, time_mean - time_std, time_mean + time_std, alpha=0.3)
-
-        ax1.set_xticks(morph)
-        ax1.set_xlabel("% morph (alpha)")
-        ax1.set_ylabel("response time (ms)")
-        ax1.legend(loc="upper right")
-
-    plt.show()
-
-
-def plot_r2(r2_values, title=None):
-    if title is None:
-        title = ""
-    else:
-        title = ", " + title
-
-    fig = plt.figure(figsize=(14, 10))
-    fig.suptitle(f"R² Values Distribution (n={len(r2_values)}) {title}", fontsize=14, fontweight="bold")
-    gs = gridspec.GridSpec(2, 2, figure=fig, hspace=0.35, wspace=0.3)
-
-    ax1 = fig.add_subplot(gs[0, 0])
-    ax1.hist(r2_values, bins=50, color="steelblue", edgecolor="white", linewidth=0.5)
-    ax1.axvline(np.mean(r2_values), color="red", linestyle="--", label=f"Mean:   {np.mean(r2_values):.3f}")
-    ax1.axvline(np.median(r2_values), color="orange", linestyle="--", label=f"Median: {np.median(r2_values):.3f}")
-    ax1.set_title("Histogram")
-    ax1.set_xlabel("R²")
-    ax1.set_ylabel("Count")
-    ax1.legend(fontsize=9)
-
-    ax2 = fig.add_subplot(gs[0, 1])
-    kde = gaussian_kde(r2_values)
-    x = np.linspace(r2_values.min(), r2_values.max(), 500)
-    ax2.plot(x, kde(x), color="steelblue", linewidth=2)
-    ax2.fill_between(x, kde(x), alpha=0.3, color="steelblue")
-    ax2.axvline(np.mean(r2_values), color="red", linestyle="--", label=f"Mean:   {np.mean(r2_values):.3f}")
-    ax2.axvline(np.median(r2_values), color="orange", linestyle="--", label=f"Median: {np.median(r2_values):.3f}")
-    ax2.set_title("Kernel Density Estimate")
-    ax2.set_xlabel("R²")
-    ax2.set_ylabel("Density")
-    ax2.legend(fontsize=9)
-
-    ax3 = fig.add_subplot(gs[1, 0])
-    """ax3.boxplot(r2_values, vert=False, patch_artist=True,
-                boxprops=dict(facecolor="steelblue", alpha=0.5),
-                medianprops=dict(color="orange", linewidth=2))
-    sample = np.random.choice(r2_values, size=min(500, len(r2_values)), replace=False)
-    ax3.scatter(sample, np.ones(len(sample)),
-                alpha=0.15, color="steelblue", s=10, zorder=3)
-    ax3.set_title("Box + Strip Plot")
-    ax3.set_xlabel("R²")
-    ax3.set_yticks([])"""
-    violin = ax3.violinplot(
-        r2_values,
-        positions=[1],
-        showmedians=True,
-        showextrema=True,
-        widths=0.6,
-        vert=False
-    )
-    ax3.boxplot(r2_values, vert=False, patch_artist=True,
-                boxprops=dict(facecolor="steelblue", alpha=0.5))
-
-    for body in violin["bodies"]:
-        body.set_facecolor("#4C72B0")
-        body.set_edgecolor("black")
-        body.set_alpha(0.8)
-
-    violin["cmedians"].set_color("red")
-    violin["cmedians"].set_linewidth(2)
-
-    violin["cmaxes"].set_color("black")
-    violin["cmins"].set_color("black")
-    violin["cbars"].set_color("black")
-
-    ax3.set_title("Distribution")
-    ax3.set_xlabel("R²", fontsize=12)
-    ax3.set_yticks([1])
-    ax3.set_yticklabels(["Model"])
-
-    ax4 = fig.add_subplot(gs[1, 1])
-    sorted_vals = np.sort(r2_values)
-    ecdf = np.arange(1, len(sorted_vals) + 1) / len(sorted_vals)
-    ax4.plot(sorted_vals, ecdf, color="steelblue", linewidth=2)
-    ax4.axhline(0.5, color="orange", linestyle="--", label="50th percentile")
-    ax4.axhline(0.25, color="gray", linestyle=":", label="25th percentile")
-    ax4.axhline(0.75, color="gray", linestyle=":", label="75th percentile")
-    ax4.set_title("Empirical CDF (ECDF)")
-    ax4.set_xlabel("R²")
-    ax4.set_ylabel("Cumulative Probability")
-    ax4.legend(fontsize=9)
-
-    stats_text = (
-        f"Min:    {r2_values.min():.3f}\n"
-        f"Max:    {r2_values.max():.3f}\n"
-        f"Mean:   {np.mean(r2_values):.3f}\n"
-        f"Median: {np.median(r2_values):.3f}\n"
-        f"Std:    {np.std(r2_values):.3f}\n"
-        f"<0:     {(r2_values < 0).sum()} values\n"  # worse than baseline
-        f">0:     {(r2_values > 0).sum()} values"  # sanity check
-    )
-    fig.text(0.5, 0.01, stats_text, ha="center", fontsize=9,
-             bbox=dict(boxstyle="round", facecolor="lightyellow", alpha=0.8))
-    return fig
-
-
-def carpet_plot(fmri_img, mask_img, t_r=2.4, standardize=True,
-                title="Carpet Plot", figsize=(14, 8)):
-
-    masker = NiftiMasker(
-        mask_img=mask_img,
-        standardize=standardize,
-        t_r=t_r
-    )
-    voxels = masker.fit_transform(fmri_img)  # shape: (timepoints, voxels)
-    # print(f"Data shape → timepoints: {voxels.shape[0]}, voxels: {voxels.shape[1]}")
-
-    global_signal = voxels.mean(axis=1)
-
-    sort_idx = np.argsort(voxels.mean(axis=0))
-    voxels_sorted = voxels[:, sort_idx].T  # shape: (voxels, timepoints)
-
-    n_timepoints = voxels.shape[0]
-    time_axis = np.arange(n_timepoints) * t_r
-
-    fig = plt.figure(figsize=figsize)
-    gs  = gridspec.GridSpec(
-        2, 1,
-        height_ratios=[1, 5],  # global signal : carpet
-        hspace=0.05
-    )
-
-    ax_gs = fig.add_subplot(gs[0])
-    ax_gs.plot(time_axis, global_signal, color="black", linewidth=0.8)
-    ax_gs.set_xlim(time_axis[0], time_axis[-1])
-    ax_gs.set_ylabel("Global\nSignal", fontsize=9)
-    ax_gs.axhline(0, color="gray", linewidth=0.5, linestyle="--")
-    ax_gs.set_xticklabels([])
-    ax_gs.spines[["top", "right"]].set_visible(False)
-    ax_gs.set_title(title, fontsize=12, fontweight="bold")
-
-    ax_cp = fig.add_subplot(gs[1])
-
-    vmin = np.percentile(voxels_sorted, 2)
-    vmax = np.percentile(voxels_sorted, 98)
-
-    im = ax_cp.imshow(
-        voxels_sorted,
-        aspect="auto",
-        cmap="gray",
-        vmin=vmin,
-        vmax=vmax,
-        interpolation="nearest",
-        extent=[time_axis[0], time_axis[-1], 0, voxels_sorted.shape[0]]
-    )
-
-    ax_cp.set_xlabel("Time (s)", fontsize=10)
-    ax_cp.set_ylabel("Voxels",   fontsize=10)
-    ax_cp.spines[["top", "right"]].set_visible(False)
-
-    cbar = fig.colorbar(im, ax=ax_cp, orientation="vertical",
-                        fraction=0.02, pad=0.02)
-    cbar.set_label("Signal\nIntensity", fontsize=8)
-
-    plt.tight_layout()
-
-    return fig
-
-
-def plot_timeseries_list(*timeseries, **kwargs):
-    data = np.array([*timeseries])
-    return plot_timeseries(data, **kwargs)
-
-
-def plot_timeseries(timeseries, labels=None, repetition_time=None, events=None, title=None):
-
-    assert repetition_time is not None, "repetition_time is None"
-
-    n_volumes = timeseries.shape[1]  # assuming shape (n_voxels, n_timepoints)
-    time_volumes = np.arange(n_volumes) * repetition_time  # e.g. [0, 2, 4, 6, ...]
-    time_seconds = np.arange(0, time_volumes[-1], 1)  # 1 second resolution
-
-    timeseries = np.array([
-        interp1d(time_volumes, timeserie, kind="linear")(time_seconds)
-        for timeserie in timeseries
-    ])
-
-    fig, ax = plt.subplots(figsize=(15, 8))
-
-    if labels is not None:
-        assert len(labels) == timeseries.shape[0], f"len(labels) != len(timeseries), {len(labels)} != {timeseries.shape[0]}"
-
-    for i, timeserie in enumerate(timeseries):
-        kwargs = {}
-
-        if labels:
-            l = labels[i]
-            kwargs["label"] = l
-
-            if "predicted" in l:
-                kwargs["linestyle"] = '--'
-
-        ax.plot(timeserie, **kwargs)
-
-    if events is not None:
-        trial_types = events["trial_type"].unique()
-        colors = plt.cm.Set1(np.linspace(0, 1, len(trial_types)))
-        color_map = dict(zip(trial_types, colors))
-
-        for _, row in events.iterrows():
-            xpos = row["onset"]
-
-            ax.axvline(
-                x=xpos,
-                ymin=0.0,
-                ymax=0.2,
-                color=color_map[row["trial_type"]],
-                linestyle="--",
-                alpha=0.7,
-                linewidth=1.5,
-                label=row["trial_type"]
-            )
-
-    handles, labels = ax.get_legend_handles_labels()
-    seen = {}
-    unique_handles, unique_labels = [], []
-    for handle, label in zip(handles, labels):
-        if label not in seen:
-            seen[label] = True
-            unique_handles.append(handle)
-            unique_labels.append(label)
-
-    ax.legend(unique_handles, unique_labels, loc="upper right", bbox_to_anchor=(1.15, 1))
-
-    if title is None:
-        title = ""
-    else:
-        title = ", " + title
-
-    ax.set_xlabel(f"Time (Seconds)")
-    ax.set_ylabel("BOLD Signal")
-    ax.set_title(f"fMRI Timeseries with Event Onsets {title}")
-    plt.tight_layout()
-    return fig
-
-
 def generate_motor_mask(merged=True, override_roi=None, folder='.'):
-    from nibabel.affines import apply_affine
-    from mri_loader import MRI
-
-    import nibabel as nib
-
-    import lib.mni_to_atlas as mni_to_atlas
-
-    mni_to_atlas._ATLASES_PATH = f"{folder}/lib"
-    atlas = mni_to_atlas.AtlasBrowser("AAL3")
-
-    ROI = ['Precentral_L', 'Precentral_R', 'Supp_Motor_Area_L', 'Supp_Motor_Area_R']
-    if override_roi:
-        ROI = override_roi
-
-    sample = MRI(1, 1, folder=folder).data
-    inv_affine = np.linalg.inv(sample.affine)
-
-    masks = {}
-    masks_image = {}
-    lookup_regions = {v: k for k, v in atlas._region_names.items()}
-
-    merged_mask = []
-
-    for region in ROI:
-        index = lookup_regions[region]
-
-        atlas_mask = np.argwhere(atlas._image == index)
-        mni_mask = atlas._convert_atlas_to_mni_space(atlas_mask)
-        image_mask = apply_affine(inv_affine, mni_mask)
-        cleaned_mask = np.unique(np.round(image_mask), axis=0).astype(np.int32)
-
-        if merged:
-            merged_mask.append(cleaned_mask)
-        else:
-
-            applied_mask = np.zeros(sample.shape[:3], dtype=np.uint8)
-            applied_mask[cleaned_mask[:, 0], cleaned_mask[:, 1], cleaned_mask[:, 2]] = 1
-
-            img = nib.Nifti1Image(applied_mask, affine=sample.affine)
-            masks_image[region] = img
-            masks[region] = NiftiMasker(mask_img=img)
-            masks[region].fit()
-
-    if merged:
-        merged_mask = np.concatenate(merged_mask, axis=0)
-
-        applied_mask = np.zeros(sample.shape[:3], dtype=np.uint8)
-        applied_mask[merged_mask[:, 0], merged_mask[:, 1], merged_mask[:, 2]] = 1
-
-        img = nib.Nifti1Image(applied_mask, affine=sample.affine)
-        mask = NiftiMasker(mask_img=img)
-        mask.fit()
-
-        return mask, img
+    import roi_masks
 
-    return masks, masks_image
+    return roi_masks.motor_mask(merged=merged, override_roi=override_roi, folder=folder)
 
 
 def generate_html(image_path1, image_path2, output_path):
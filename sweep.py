@@ -0,0 +1,157 @@
+"""Parallel, resumable sweep over gen_contrasts configurations.
+
+The grid is expanded into (configuration, subject) tasks. Tasks sharing the
+same smoothed images (same subject, confounds and smoothing) run together in
+one worker, which smooths once and fits every design on top of it. Each task
+writes its z-maps atomically followed by a status file, so an interrupted
+sweep resumes where it stopped, and region plots are made once all subjects
+of a configuration have a status.
+"""
+import os
+import copy
+import json
+import time
+from itertools import product
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import gen_contrasts as gc
+import contrast_store
+from mri_loader import Subject
+
+
+# parameters changing the smoothed images, the other ones only change the design
+SHARED_PARAMETERS = ("SUBJECTS", "CONFOUND_MODE", "VOLUMES_OFFSET", "SMOOTHING_FWHM", "FIT_PER_RUN")
+
+
+def expand(base_cfg, grid):
+    configs = []
+
+    for values in product(*grid.values()):
+        cfg = copy.copy(base_cfg)
+        for name, value in zip(grid.keys(), values):
+            setattr(cfg, name, value)
+
+        # parallelism comes from the pool, not from each model
+        cfg.N_JOBS = 1
+        configs.append(cfg)
+
+    return configs
+
+
+def status_path(cfg, subject):
+    return f"brute_force/{gc.path(cfg)}/status/sub-{subject}.json"
+
+
+def read_status(cfg, subject):
+    try:
+        with open(status_path(cfg, subject)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_status(cfg, subject, status, seconds=0.0, error=""):
+    target = status_path(cfg, subject)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"subject": subject, "status": status, "seconds": seconds, "error": error}, f)
+    os.replace(tmp_path, target)
+
+
+def run_group(cfgs, subject):
+    """Fit every configuration of `cfgs` (sharing SHARED_PARAMETERS) for one subject."""
+    results = []
+
+    try:
+        # cleaned runs are cached on disk for the other configurations and workers
+        dataset = Subject(subject, gc.run_ids, confound_mode=cfgs[0].CONFOUND_MODE)
+        for run in dataset._dataset:
+            run.cache()
+
+        smoothed = gc.smoothed_images(cfgs[0], subject)
+    except Exception as e:
+        for cfg in cfgs:
+            write_status(cfg, subject, "failed", error=str(e))
+            results.append((gc.path(cfg), subject, "failed", 0.0, str(e)))
+        return results
+
+    for cfg in cfgs:
+        start = time.perf_counter()
+        labels_col, morph_response = gc.get_predictors(cfg)
+
+        try:
+            gc.GLM_contrast_map(cfg, gc.ZMapStore(cfg), subject, labels_col, morph_response, smoothed=smoothed)
+
+            seconds = time.perf_counter() - start
+            write_status(cfg, subject, "done", seconds)
+            results.append((gc.path(cfg), subject, "done", seconds, ""))
+        except Exception as e:
+            write_status(cfg, subject, "failed", error=str(e))
+            results.append((gc.path(cfg), subject, "failed", 0.0, str(e)))
+
+    return results
+
+
+def regions_done(cfg):
+    for correction in cfg.CORRECTIONS:
+        cor_name = '_'.join(str(c) for c in correction).replace('0.', "p")
+        if not os.path.exists(f"brute_force/{gc.path(cfg)}/regions/{cor_name}.png"):
+            return False
+    return True
+
+
+def load_z_maps(cfg, subjects):
+    # one stack file per configuration, reused by the group analyses
+    contrasts = [gc.contrast_name(contrast) for contrast in gc.gen_contrast_list(cfg.PREDICTORS)]
+
+    # a subject "done" without the map of a contrast its design could not express is left out
+    complete = gc.subjects_with_maps(cfg, subjects, contrasts)
+    if len(complete) < len(subjects):
+        print(f"{gc.path(cfg)}: subjects {sorted(set(subjects) - set(complete))} miss contrast maps, left out")
+    if not complete:
+        return {c_name: {} for c_name in contrasts}
+
+    stack = contrast_store.load(cfg, complete, contrasts)
+
+    return {c_name: dict(zip(stack.subjects, stack.images(c_name))) for c_name in contrasts}
+
+
+def run_sweep(base_cfg, grid, workers=None, retry_failed=False):
+    configs = expand(base_cfg, grid)
+
+    subject_ids = {}
+    for cfg in configs:
+        key = (cfg.SUBJECTS, cfg.EXCLUDE_WITH_SIGMOID)
+        if key not in subject_ids:
+            subject_ids[key] = gc.get_subject_ids(cfg)
+
+    groups = defaultdict(list)
+    for cfg in configs:
+        shared = tuple(getattr(cfg, name) for name in SHARED_PARAMETERS)
+
+        for subject in subject_ids[(cfg.SUBJECTS, cfg.EXCLUDE_WITH_SIGMOID)]:
+            status = read_status(cfg, subject)
+            if status is None or (retry_failed and status["status"] == "failed"):
+                groups[(shared, subject)].append(cfg)
+
+    print(f"{len(configs)} configurations, {sum(len(g) for g in groups.values())} (configuration, subject) tasks to run")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_group, cfgs, subject) for (_, subject), cfgs in groups.items()]
+
+        for future in as_completed(futures):
+            for filepath, subject, status, seconds, error in future.result():
+                print(f"{filepath} sub-{subject}: {status} {seconds:.1f}s {error}")
+
+    for cfg in configs:
+        subjects = subject_ids[(cfg.SUBJECTS, cfg.EXCLUDE_WITH_SIGMOID)]
+        statuses = {subject: read_status(cfg, subject) for subject in subjects}
+
+        if any(status is None for status in statuses.values()) or regions_done(cfg):
+            continue
+
+        done = {subject for subject, status in statuses.items() if status["status"] == "done"}
+        gc.save_regions(cfg, load_z_maps(cfg, done), subjects)
@@ -0,0 +1,49 @@
+import os
+import sys
+
+import numpy as np
+import nibabel
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gen_contrasts as gc
+import sweep
+
+
+def save_map(cfg, subject, c_name, value):
+    path = gc.contrast_path(cfg, subject, c_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    data = np.zeros((4, 4, 4), dtype=np.float32)
+    data[1:3, 1:3, 1:3] = value
+    nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), path)
+
+
+def test_load_z_maps_leaves_out_subjects_missing_a_map(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cfg = gc.Config()
+    contrasts = [gc.contrast_name(contrast) for contrast in gc.gen_contrast_list(cfg.PREDICTORS)]
+
+    for subject in (1, 2, 3):
+        for c_name in contrasts:
+            save_map(cfg, subject, c_name, subject)
+
+    # subject 2's design could not express the last contrast
+    os.remove(gc.contrast_path(cfg, 2, contrasts[-1]))
+
+    z_maps = sweep.load_z_maps(cfg, {1, 2, 3})
+
+    assert list(z_maps) == contrasts
+    for c_name in contrasts:
+        assert list(z_maps[c_name]) == [1, 3]
+        assert np.asarray(z_maps[c_name][3].dataobj).max() == 3
+
+
+def test_load_z_maps_without_complete_subject(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    cfg = gc.Config()
+    contrasts = [gc.contrast_name(contrast) for contrast in gc.gen_contrast_list(cfg.PREDICTORS)]
+
+    save_map(cfg, 1, contrasts[0], 1)
+
+    assert sweep.load_z_maps(cfg, {1}) == {c_name: {} for c_name in contrasts}